@@ -29,6 +29,24 @@ BLOG = {
     # You can override this default for each page through a handler's call to 
     #  view.ViewPage(cache_time=...)
     "cache_time": 0 if DEBUG else 3600,
+    # Once a page's cache_time is up, it can still be served for this many
+    #  seconds while a single request re-renders it.
+    "cache_stale_time": 0 if DEBUG else 300,
+    # Cached pages are stored gzipped.  Set to True to send those bytes as-is
+    #  (Content-Encoding: gzip) to clients that accept gzip.  Leave False
+    #  where the front end drops or rewrites Content-Encoding, as App Engine
+    #  does; pages are then decompressed before sending.
+    "send_gzip": False,
+    # Bytes of gzipped pages each instance keeps in memory in front of
+    #  memcache.
+    "local_cache_bytes": 4 * 1024 * 1024,
+    # Seconds each instance reuses the cache generation numbers it read, 
+    #  so pages in its memory are served without a memcache call.  Other
+    #  instances see a write up to this much later.
+    "generation_cache_time": 2,
+    # Most pages re-rendered after an article is published or edited, so
+    #  readers don't hit cold cache entries.
+    "warm_max_urls": 10,
 
     # Use the default YUI-based theme.
     # If another string is used besides 'default', calls to static files and
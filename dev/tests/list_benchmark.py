@@ -0,0 +1,47 @@
+"""
+Measures decoding of the tag list cached by MemcachedModel.list().
+
+Compares the old repr()/eval() encoding with models.pack_list() and
+models.unpack_list() for lists of 100, 1,000 and 10,000 tags.
+
+Run from the application root with the App Engine SDK on PYTHONPATH:
+  python dev/tests/list_benchmark.py [decodes]
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault('SERVER_SOFTWARE', 'TestServer/1.0')
+sys.path.insert(0, os.getcwd())
+
+import models
+
+def make_tags(num_tags):
+    """Returns dicts shaped like Tag.list() entries."""
+    return [{'name': 'tag%d' % i, 'count': i % 50} for i in xrange(num_tags)]
+
+def time_decodes(decode_func, data, num_decodes):
+    start_time = time.time()
+    for i in xrange(num_decodes):
+        decode_func(data)
+    return (time.time() - start_time) / num_decodes
+
+def main(argv):
+    num_decodes = 200
+    if len(argv) > 1:
+        num_decodes = int(argv[1])
+    print "%d decodes each" % num_decodes
+    for num_tags in [100, 1000, 10000]:
+        tags = make_tags(num_tags)
+        list_repr = '[' + ','.join([repr(tag) for tag in tags]) + ']'
+        packed = models.pack_list(tags)
+        assert models.unpack_list(packed) == eval(list_repr)
+        old = time_decodes(eval, list_repr, num_decodes)
+        new = time_decodes(models.unpack_list, packed, num_decodes)
+        print "%5d tags:  repr/eval %8.1f us, %7d bytes" % (
+            num_tags, old * 1e6, len(list_repr))
+        print "             pack_list %8.1f us, %7d bytes" % (
+            new * 1e6, len(packed))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,90 @@
+"""
+Measures the per-render overhead of utils.template.
+
+Compares rendering a compiled template the old way, swapping Django
+settings and the {% url %} node around each render, with the current
+path that binds template directories to the compiled template.  Both
+wrappers are also timed around a render that does nothing, which gives
+their overhead alone.
+
+Run from the application root with the App Engine SDK on PYTHONPATH:
+  python dev/tests/template_benchmark.py [renders]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('SERVER_SOFTWARE', 'TestServer/1.0')
+sys.path.insert(0, os.getcwd())
+
+import django.template
+from utils import template
+
+BASE = """<html><body>{% block content %}{% endblock %}
+{% include "footer.html" %}</body></html>"""
+CHILD = """{% extends "base.html" %}{% block content %}
+{% for item in items %}<p>{{ item }}</p>{% endfor %}{% endblock %}"""
+FOOTER = """<div>{{ title }}</div>"""
+
+def swapping_render(render, context, template_dirs):
+    """What utils.template used to do around every render."""
+    new_settings = {'TEMPLATE_DIRS': template_dirs, 
+                    'TEMPLATE_DEBUG': False, 'DEBUG': False}
+    URLNode = django.template.defaulttags.URLNode
+    save_urlnode_render = URLNode.render
+    old_settings = template._swap_settings(new_settings)
+    try:
+        URLNode.render = template._urlnode_render_replacement
+        return render(context)
+    finally:
+        template._swap_settings(old_settings)
+        URLNode.render = save_urlnode_render
+
+def time_renders(render_func, num_renders):
+    start_time = time.time()
+    for i in xrange(num_renders):
+        render_func()
+    return (time.time() - start_time) / num_renders
+
+def main(argv):
+    num_renders = 2000
+    if len(argv) > 1:
+        num_renders = int(argv[1])
+    template_dir = tempfile.mkdtemp()
+    try:
+        for name, source in [('base.html', BASE), ('child.html', CHILD),
+                             ('footer.html', FOOTER)]:
+            f = open(os.path.join(template_dir, name), 'w')
+            f.write(source)
+            f.close()
+        template_dirs = [template_dir]
+        params = {'title': 'Benchmark', 'items': range(20)}
+        bound = template.load('child.html', False, template_dirs)
+        context = template.Context(params)
+
+        old = time_renders(
+            lambda: swapping_render(bound.raw_render, context, 
+                                    template_dirs),
+            num_renders)
+        new = time_renders(lambda: bound.render(context), num_renders)
+        def no_render(context):
+            return ''
+        old_overhead = time_renders(
+            lambda: swapping_render(no_render, context, template_dirs),
+            num_renders)
+        new_overhead = time_renders(
+            lambda: template._call_bound(template_dirs, False, no_render,
+                                         context),
+            num_renders)
+        print "%d renders each" % num_renders
+        print "settings swapping:  %.1f us/render, %.1f us overhead" % \
+            (old * 1e6, old_overhead * 1e6)
+        print "bound directories:  %.1f us/render, %.1f us overhead" % \
+            (new * 1e6, new_overhead * 1e6)
+    finally:
+        shutil.rmtree(template_dir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,13 +1,16 @@
 import unittest
 import urllib
 from utils import template
+from utils import lru_cache
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_file_stub
 from google.appengine.api import user_service_stub
 from google.appengine.api import urlfetch_stub
 from google.appengine.api import mail_stub
+from google.appengine.api import memcache
 from google.appengine.api.memcache import memcache_stub
 from google.appengine.ext import webapp
+import datetime
 import os
 import time
 
@@ -24,6 +27,9 @@ time.tzset()
 
 from handlers.bloog import blog
 import models.blog
+import view
+import config
+from utils.external import simplejson
 
 class BloogTest(unittest.TestCase):
 
@@ -54,11 +60,22 @@ class BloogTest(unittest.TestCase):
         apiproxy_stub_map.apiproxy.RegisterStub(
          'memcache', memcache_stub.MemcacheServiceStub())
 
+        # Start with an empty per-instance page cache.
+        view.LOCAL_CACHE.clear()
+        view.GENERATIONS.clear()
+
+        # Don't fetch pages to warm the cache after writes.
+        config.BLOG['warm_max_urls'] = 0
+
         # Create a fake remplate renderer
         self.render_calls = []
         def template_render(filename, params, debug, template_dirs):
             self.render_calls.append(params)
+            return ''
         template.render = template_render
+        def template_stream(filename, params, write, debug, template_dirs):
+            self.render_calls.append(params)
+        template.stream = template_stream
     
     def createHandler(self, cls, uri, env=None, auth=False):
         handler = cls()
@@ -81,6 +98,334 @@ class BloogTest(unittest.TestCase):
         root.get()
         self.failUnlessEqual(len(self.render_calls), 1)
         self.failUnlessEqual(self.render_calls[0]['articles'], [])
+        self.failUnlessEqual(response.headers['Vary'], 'Accept')
+
+    def testRootCachedForSignedInUser(self):
+        for i in range(2):
+            root, request, response = self.createHandler(blog.RootHandler, 
+                                                         '/')
+            root.get()
+        self.failUnlessEqual(len(self.render_calls), 1)
+        self.failUnless(isinstance(self.render_calls[0]['user'], 
+                                   view.UserPlaceholder))
+
+    def testQueryNoiseSharesCachedView(self):
+        for query in ['', 'utm_source=feed', 'offset=0&limit=5', 
+                      'limit=5&offset=0&utm_medium=x']:
+            root, request, response = self.createHandler(blog.RootHandler, 
+                '/', {'QUERY_STRING': query})
+            root.get()
+        self.failUnlessEqual(len(self.render_calls), 2)
+
+    def testLocalCacheKeepsOutputWithoutGzip(self):
+        send_gzip = config.BLOG['send_gzip']
+        config.BLOG['send_gzip'] = False
+        try:
+            for i in range(2):
+                root, request, response = self.createHandler(
+                                              blog.RootHandler, '/')
+                root.get()
+        finally:
+            config.BLOG['send_gzip'] = send_gzip
+        self.failUnlessEqual(len(self.render_calls), 1)
+        self.failUnlessEqual(len(view.LOCAL_CACHE), 1)
+        data = view.LOCAL_CACHE.entries.values()[0][3]
+        self.failUnless('output' in data)
+        self.failIf('gzip' in data)
+
+    def testLRUCacheEvictsBySize(self):
+        cache = lru_cache.LRUCache(10)
+        cache.set('a', 'aaaa', 4)
+        cache.set('b', 'bbbb', 4)
+        cache.get('a')          # Now 'b' is least recently used.
+        cache.set('c', 'cc', 2)
+        self.failUnlessEqual(cache.num_bytes, 10)
+        cache.set('d', 'dd', 2)
+        self.failUnlessEqual(cache.get('b'), None)
+        self.failUnlessEqual(cache.get('a'), 'aaaa')
+        self.failUnlessEqual(cache.num_bytes, 8)
+        cache.set('a', 'a', 1)  # Replacing an entry frees its old size.
+        self.failUnlessEqual(cache.num_bytes, 5)
+        self.failIf(cache.set('e', 'x' * 11, 11))
+        self.failUnlessEqual(len(cache), 3)
+
+    def testLocalHitSkipsGenerationRead(self):
+        root, request, response = self.createHandler(blog.RootHandler, '/')
+        root.get()
+        save_get_multi = memcache.get_multi
+        def get_multi(*args, **kwds):
+            self.fail('Generations read from memcache')
+        memcache.get_multi = get_multi
+        try:
+            root, request, response = self.createHandler(blog.RootHandler,
+                                                         '/')
+            root.get()
+        finally:
+            memcache.get_multi = save_get_multi
+        self.failUnlessEqual(len(self.render_calls), 1)
+
+    def testCachedViewUsesCanonicalUrl(self):
+        os.environ['USER_EMAIL'] = ''
+        root, request, response = self.createHandler(blog.RootHandler, 
+            '/', {'QUERY_STRING': 'utm_source=feed&limit=5'})
+        root.get()
+        params = self.render_calls[0]
+        self.failUnlessEqual(params['current_url'], 
+                             'http://%s/?limit=5' % HOST)
+        self.failIf('utm_source' in params['login_url'])
+
+    def testFragmentExpiresLocally(self):
+        renders = []
+        def render():
+            renders.append(1)
+            return 'tags'
+        for i in range(2):
+            self.failUnlessEqual(view.get_fragment('tags', render, 60), 
+                                 'tags')
+        self.failUnlessEqual(len(renders), 1)
+        save_time = time.time
+        time.time = lambda: save_time() + 61
+        try:
+            view.get_fragment('tags', render, 60)
+        finally:
+            time.time = save_time
+        self.failUnlessEqual(len(renders), 2)
+
+    def testUncachedViewIsStreamed(self):
+        for i in range(2):
+            root, request, response = self.createHandler(blog.RootHandler, 
+                                                         '/')
+            view.ViewPage(cache_time=0).render(root, {'articles': []})
+        self.failUnlessEqual(len(self.render_calls), 2)
+        self.failIf('ETag' in response.headers)
+
+    def testRootJsonListing(self):
+        models.blog.Article(permalink='2008/05/entry', title='Entry', 
+                            article_type='blog entry', body='Body', 
+                            format='html').put()
+        root, request, response = self.createHandler(blog.RootHandler, '/', 
+            {'HTTP_ACCEPT': 'application/json', 
+             'QUERY_STRING': 'fields=title,permalink'})
+        root.get()
+        self.failUnlessEqual(len(self.render_calls), 0)
+        self.failUnlessEqual(simplejson.loads(response.out.getvalue()),
+                             [{'title': 'Entry', 
+                               'permalink': '2008/05/entry'}])
+        self.failUnlessEqual(response.headers['Vary'], 'Accept')
+
+    def testArticleJson(self):
+        tag_key = models.blog.Tag.get_or_insert('foo').key()
+        article = models.blog.Article(permalink='json-post', title='Json', 
+            article_type='article', body='Body', format='html',
+            published=datetime.datetime(2008, 5, 6, 7, 8, 9),
+            tag_keys=[tag_key], assoc_dict='pickled')
+        article.put()
+        values = simplejson.loads(article.to_json())
+        self.failUnlessEqual(values['published'], '2008-05-06 07:08:09')
+        self.failUnlessEqual(values['tag_keys'], [str(tag_key)])
+        self.failIf('assoc_dict' in values)
+        comment = models.blog.Comment(article=article, thread='001', 
+                                      body='Comment')
+        comment.put()
+        self.failUnlessEqual(simplejson.loads(comment.to_json())['article'],
+                             str(article.key()))
+
+        # The json is cached until the article is saved again.
+        self.failUnless(memcache.get(article.json_cache_key()))
+        article.title = 'Changed'
+        article.put()
+        self.failUnlessEqual(memcache.get(article.json_cache_key()), None)
+        self.failUnlessEqual(simplejson.loads(article.to_json())['title'], 
+                             'Changed')
+
+    def testMigrateArticleToPermalinkKey(self):
+        article = models.blog.Article(permalink='old-post', title='Old', 
+                                      article_type='article', body='Body',
+                                      format='html')
+        article.put()
+        self.failUnlessEqual(
+            models.blog.Article.get_by_permalink('old-post').key(), 
+            article.key())
+        migrated = models.blog.migrate_article(article)
+        self.failUnlessEqual(migrated.key().name(), 'permalink:old-post')
+        self.failUnlessEqual(models.blog.Article.all().count(), 1)
+        self.failUnlessEqual(
+            models.blog.Article.get_by_permalink('old-post').key(), 
+            migrated.key())
+
+    def testBufferedCounter(self):
+        counter = models.Counter('buffered', buffered=True, flush_deltas=100)
+        counter.increment()     # The first change flushes at once.
+        for i in range(3):
+            counter.decrement()
+        self.failUnlessEqual(counter.get_pending(), -3)
+        self.failUnlessEqual(counter.get_count(nocache=True), -2)
+        self.failUnless(counter.flush())
+        self.failUnlessEqual(counter.get_pending(), 0)
+        shards = models.CounterShard.all().filter('name =', 'buffered')
+        self.failUnlessEqual(sum([shard.count for shard in shards]), -2)
+        self.failUnlessEqual(counter.get_count(nocache=True), -2)
+
+    def testCounterGrowsAndConsolidates(self):
+        counter = models.Counter('hot', num_shards=2)
+        for i in range(models.Counter.GROW_CONTENTION):
+            counter.record_contention(counter.get_num_shards())
+        self.failUnlessEqual(counter.get_num_shards(), 4)
+        for index in range(1, 5):
+            models.CounterShard(
+                key_name=models.CounterShard.get_key_name('hot', index),
+                name='hot', count=index).put()
+        # Shards written within the idle time keep the counter grown.
+        self.failUnlessEqual(models.Counter.consolidate_idle(600), [])
+        self.failUnlessEqual(counter.get_num_shards(), 4)
+        self.failUnlessEqual(models.Counter.consolidate_idle(0), ['hot'])
+        self.failUnlessEqual(models.CounterConfig.all().count(), 0)
+        shards = models.CounterShard.all().filter('name =', 'hot').fetch(10)
+        self.failUnlessEqual(len(shards), 2)
+        self.failUnlessEqual(sum([shard.count for shard in shards]), 10)
+        self.failUnlessEqual(counter.get_num_shards(), 2)
+        self.failUnlessEqual(counter.get_count(nocache=True), 10)
+
+    def testGetCountsInBatches(self):
+        save_keys_per_get = models.Counter.MAX_KEYS_PER_GET
+        models.Counter.MAX_KEYS_PER_GET = 3
+        try:
+            for name, total in [('a', 1), ('b', 2), ('c', 0), ('d', 5)]:
+                counter = models.Counter(name, num_shards=2)
+                for i in range(total):
+                    counter.increment()
+            models.Counter('d', num_shards=2).set_num_shards(4)
+            models.CounterShard(
+                key_name=models.CounterShard.get_key_name('d', 4),
+                name='d', count=10).put()
+            memcache.flush_all()
+            counts = models.Counter.get_counts(['a', 'b', 'c', 'd', 'e'],
+                                               num_shards=2)
+        finally:
+            models.Counter.MAX_KEYS_PER_GET = save_keys_per_get
+        self.failUnlessEqual(counts, {'a': 1, 'b': 2, 'c': 0, 'd': 15, 
+                                      'e': 0})
+        # Counts are now cached.
+        self.failUnlessEqual(memcache.get('Counterd'), '15')
+
+    def testBufferedCounterDoesNotGrow(self):
+        counter = models.Counter('calm', num_shards=2, buffered=True)
+        save_increment = models.CounterShard.__dict__['increment']
+        models.CounterShard.increment = classmethod(
+            lambda cls, name, num_shards, downward=False, amount=1: 2)
+        try:
+            for i in range(models.Counter.GROW_CONTENTION):
+                counter.add_pending(1)
+                counter.flush()
+        finally:
+            models.CounterShard.increment = save_increment
+        self.failUnlessEqual(counter.get_num_shards(), 2)
+
+    def testFlushTagCounters(self):
+        for name in ['busy', 'quiet']:
+            models.blog.Tag.get_or_insert(name)
+        busy = models.blog.Tag.get_by_key_name('busy').counter
+        busy.add_pending(3)
+        models.blog.Tag.flush_counters()
+        self.failUnlessEqual(busy.get_pending(), 0)
+        self.failUnlessEqual(busy.get_count(nocache=True), 3)
+        # Counters without pending changes aren't touched.
+        quiet = models.blog.Tag.get_by_key_name('quiet').counter
+        self.failUnlessEqual(memcache.get(quiet.flush_key()), None)
+
+    def testUncachedCountAfterSnapshot(self):
+        counter = models.Counter('snapshot')
+        counter.increment()
+        counter.increment()
+        self.failUnlessEqual(counter.take_snapshot().count, 2)
+        counter.increment()
+        counter.decrement()
+        counter.increment()
+        self.failUnlessEqual(counter.get_count(nocache=True), 3)
+
+    def testTagListChunks(self):
+        save_chunk_size = models.LIST_CHUNK_SIZE
+        models.LIST_CHUNK_SIZE = 2
+        try:
+            for name in ['a', 'b', 'c']:
+                models.blog.Tag.get_or_insert(name)
+            names = [tag['name'] for tag in models.blog.Tag.list()]
+            self.failUnlessEqual(names, ['a', 'b', 'c'])
+            models.blog.Tag.get_or_insert('d')
+            names = [tag['name'] for tag in models.blog.Tag.iter_list()]
+            self.failUnlessEqual(names, ['a', 'b', 'c', 'd'])
+        finally:
+            models.LIST_CHUNK_SIZE = save_chunk_size
+
+    def testConditionalGet(self):
+        os.environ['USER_EMAIL'] = ''
+        root, request, response = self.createHandler(blog.RootHandler, '/')
+        root.get()
+        last_modified = response.headers['Last-Modified']
+        for header, value in [('HTTP_IF_MODIFIED_SINCE', last_modified),
+                              ('HTTP_IF_NONE_MATCH', 
+                               response.headers['ETag'])]:
+            root, request, response = self.createHandler(blog.RootHandler, 
+                                                         '/', {header: value})
+            root.get()
+            self.failUnlessEqual(response.status(), 304)
+
+        # A write that invalidates the view moves Last-Modified on.
+        view.invalidate_cache(['listing'])
+        save_time = time.time
+        time.time = lambda: save_time() + 10
+        try:
+            root, request, response = self.createHandler(blog.RootHandler, 
+                '/', {'HTTP_IF_MODIFIED_SINCE': last_modified})
+            root.get()
+        finally:
+            time.time = save_time
+        self.failUnlessEqual(response.status(), 200)
+        self.failUnlessEqual(len(self.render_calls), 2)
+
+    def testStaleViewServedWhileReRendering(self):
+        def get_root():
+            root, request, response = self.createHandler(blog.RootHandler,
+                                                         '/')
+            root.get()
+            return root
+        root = get_root()
+        full_renders = view.NUM_FULL_RENDERS.get('/', 0)
+        stale_hits = view.NUM_STALE_HITS.get('/', 0)
+        lock_key = 'Lock' + view.ViewPage(depends_on=['listing']).cache_key(
+                                root, {}, view.get_role())
+        save_time = time.time
+        time.time = lambda: save_time() + config.BLOG['cache_time'] + 1
+        try:
+            # Another request holds the lock, so the stale copy is served.
+            memcache.add(lock_key, 1)
+            get_root()
+            self.failUnlessEqual(view.NUM_STALE_HITS.get('/', 0), 
+                                 stale_hits + 1)
+            self.failUnlessEqual(len(self.render_calls), 1)
+            # The first request to take the lock re-renders, once.
+            memcache.delete(lock_key)
+            get_root()
+            get_root()
+        finally:
+            time.time = save_time
+        self.failUnlessEqual(view.NUM_FULL_RENDERS.get('/', 0), 
+                             full_renders + 1)
+        self.failUnlessEqual(view.NUM_STALE_HITS.get('/', 0), 
+                             stale_hits + 1)
+        self.failUnlessEqual(len(self.render_calls), 2)
+
+    def testLazyListFetchedOnce(self):
+        calls = []
+        def fetch():
+            calls.append(1)
+            return ['foo', 'bar']
+        tags = view.LazyList(fetch)
+        self.failUnlessEqual(calls, [])
+        self.failUnless(tags)
+        self.failUnlessEqual(len(tags), 2)
+        self.failUnlessEqual(list(tags), ['foo', 'bar'])
+        self.failUnlessEqual(calls, [1])
 
     def testArticleSubmission(self):
         root, request, response = self.createHandler(blog.RootHandler, '/', {
@@ -120,6 +465,40 @@ class BloogTest(unittest.TestCase):
         self.failUnlessEqual(self.render_calls[1]['article'].key(),
                              article.key())
 
+    def testMissingPathRemembered(self):
+        handler, request, response = self.createHandler(blog.ArticleHandler,
+                                                        '/Test-post')
+        handler.get('Test-post')
+        self.failUnless(memcache.get(blog.not_found_key('Test-post')))
+
+        # The second request doesn't look the path up again.
+        save_get_by_permalink = \
+            models.blog.Article.__dict__['get_by_permalink']
+        def get_by_permalink(permalink):
+            self.fail('Missing path looked up in the datastore')
+        models.blog.Article.get_by_permalink = staticmethod(get_by_permalink)
+        try:
+            handler, request, response = self.createHandler(
+                                             blog.ArticleHandler, '/Test-post')
+            handler.get('Test-post')
+        finally:
+            models.blog.Article.get_by_permalink = save_get_by_permalink
+
+        root, request, response = self.createHandler(blog.RootHandler, '/', {
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'REQUEST_METHOD': 'POST',
+        })
+        request.body = urllib.urlencode({'title': 'Test post', 
+                                         'body': 'Post body',
+                                         'format': 'html'})
+        root.post()
+        self.failIf(memcache.get(blog.not_found_key('Test-post')))
+        handler, request, response = self.createHandler(blog.ArticleHandler,
+                                                        '/Test-post')
+        handler.get('Test-post')
+        self.failUnlessEqual(self.render_calls[-1]['article'].permalink,
+                             'Test-post')
+
     def testPostSubmission(self):
         url = '2008/1'
         root, request, response = self.createHandler(blog.MonthHandler, url, {
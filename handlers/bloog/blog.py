@@ -42,6 +42,7 @@ import string
 import re
 import os
 import cgi
+import hashlib
 import urllib
 
 import logging
@@ -51,9 +52,11 @@ from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext.webapp import template
 from google.appengine.api import mail
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 
 from handlers import restful
+from handlers.bloog import warmer
 from utils import authorized
 from utils import sanitizer
 import models
@@ -63,6 +66,10 @@ import config
 import legacy_aliases   # This can be either manually created or 
                         # autogenerated using the drupal_uploader utility
 
+# Lowercased aliases for case-insensitive lookup
+legacy_redirects = dict([(alias.lower(), url) for alias, url 
+                         in legacy_aliases.redirects.iteritems()])
+
 # Functions to generate permalinks depending on type of article
 permalink_funcs = {
     'article': lambda title,date: get_friendly_url(title),
@@ -87,6 +94,15 @@ def legacy_id_mapping(path, legacy_program):
                     filter('legacy_id =', url_match.group(1)).get()
     return None
 
+# Paths with no article are remembered for a short while so repeated
+#  requests for junk urls skip the datastore queries.
+NOT_FOUND_CACHE_TIME = 600
+
+def not_found_key(path):
+    if isinstance(path, unicode):
+        path = path.encode(config.BLOG['charset'])
+    return 'NotFound:' + hashlib.md5(path).hexdigest()
+
 # Module methods to handle incoming data
 def get_datetime(time_string = None):
     if time_string:
@@ -102,6 +118,15 @@ def get_tag_key(tag_name):
     obj = models.blog.Tag.get_or_insert(tag_name)
     return obj.key()
 
+def change_tag_counts(added_keys=[], removed_keys=[]):
+    """Bumps tag counters and drops the cached Tag.list() holding them."""
+    for key in removed_keys:
+        db.get(key).counter.decrement()
+    for key in added_keys:
+        db.get(key).counter.increment()
+    if added_keys or removed_keys:
+        memcache.delete(models.blog.Tag.memcache_key())
+
 def process_tag(tag_name, tags):
     # Check tag_name against all 'name' values in tags and coerce
     tag_name = tag_name.strip()
@@ -117,9 +142,7 @@ def get_tags(tags_string):
     logging.debug("get_tags: tag_string = %s", tags_string)
     if tags_string:
         from models.blog import Tag
-        tags = Tag.list()
-        logging.debug("  tags = %s", tags)
-        return [process_tag(s, tags)
+        return [process_tag(s, Tag.iter_list())
                 for s in tags_string.split(",") if s != '']
     return None
     
@@ -162,6 +185,22 @@ def process_embedded_code(article):
     article.html, languages = codehighlighter.process_html(article.html)
     article.embedded_code = languages
 
+def get_article_paths(article):
+    """Returns paths of the pages showing the article, most visited first."""
+    if article.article_type == 'blog entry':
+        paths = ['/']
+    else:
+        paths = ['/articles']
+    paths.append('/' + article.permalink)
+    paths.append(config.BLOG['master_atom_url'])
+    for tag in article.tags:
+        paths.append('/tag/' + urllib.quote(tag.encode(config.BLOG['charset'])))
+    if article.published:
+        paths.append('/%d' % article.published.year)
+        paths.append('/%d/%d' % (article.published.year, 
+                                 article.published.month))
+    return paths
+
 def process_article_edit(handler, permalink):
     # For http PUT, the parameters are passed in URIencoded string in body
     body = handler.request.body
@@ -183,19 +222,22 @@ def process_article_edit(handler, permalink):
         if 'tags' in property_hash:
             property_hash['tag_keys'] = [get_tag_key(name) 
                                          for name in property_hash['tags']]
-        article = db.Query(models.blog.Article).filter('permalink =', permalink).get()
+        article = models.blog.Article.get_by_permalink(permalink)
+        dependencies = ['tag:' + tag for tag in article.tags]
         before_tags = set(article.tag_keys)
         for key,value in property_hash.iteritems():
             setattr(article, key, value)
         after_tags = set(article.tag_keys)
-        for removed_tag in before_tags - after_tags:
-            db.get(removed_tag).counter.decrement()
-        for added_tag in after_tags - before_tags:
-            db.get(added_tag).counter.increment()
+        change_tag_counts(added_keys=list(after_tags - before_tags),
+                          removed_keys=list(before_tags - after_tags))
+        if before_tags != after_tags:
+            dependencies.append('tags')
         process_embedded_code(article)
         article.put()
         restful.send_successful_response(handler, '/' + article.permalink)
-        view.invalidate_cache()
+        view.invalidate_cache(dependencies + 
+                              view.article_dependencies(article))
+        warmer.queue_warming(get_article_paths(article))
     else:
         handler.error(400)
 
@@ -217,17 +259,26 @@ def process_article_submission(handler, article_type):
                                          for name in property_hash['tags']]
         property_hash['format'] = 'html'   # For now, convert all to HTML
         property_hash['article_type'] = article_type
-        article = models.blog.Article(**property_hash)
+        permalink = property_hash['permalink']
+        if models.blog.Article.get_by_permalink(permalink):
+            logging.warning("Article with permalink %s already exists", 
+                            permalink)
+            handler.error(409)
+            return
+        article = models.blog.Article(
+            key_name=models.blog.Article.get_key_name(permalink),
+            **property_hash)
         article.set_associated_data(
             {'relevant_links': handler.request.get('relevant_links'),
              'amazon_items': handler.request.get('amazon_items')})
         process_embedded_code(article)
         article.put()
-        for key in article.tag_keys:
-            db.get(key).counter.increment()
+        memcache.delete(not_found_key(article.permalink))
+        change_tag_counts(added_keys=article.tag_keys)
         do_sitemap_ping()
         restful.send_successful_response(handler, '/' + article.permalink)
-        view.invalidate_cache()
+        view.invalidate_cache(['tags'] + view.article_dependencies(article))
+        warmer.queue_warming(get_article_paths(article))
     else:
         handler.error(400)
 
@@ -312,18 +363,13 @@ def process_comment_submission(handler, article):
         { 'comment': comment, "use_gravatars": config.BLOG["use_gravatars"] },
         debug=config.DEBUG)
     handler.response.out.write(response)
-    view.invalidate_cache()
+    view.invalidate_cache(view.article_dependencies(article))
 
 def render_article(handler, article):
     if article:
         # Check if client is requesting javascript and
         # return json if javascript is #1 in Accept header.
-        try:
-            accept_list = handler.request.headers['Accept']
-        except KeyError:
-            logging.info("Had no accept header: %s", handler.request.headers)
-            accept_list = None
-        if accept_list and accept_list.split(',')[0] == 'application/json':
+        if view.accepts_json(handler):
             handler.response.headers['Content-Type'] = 'application/json'
             handler.response.out.write(article.to_json())
         else:
@@ -352,7 +398,9 @@ def render_article(handler, article):
         # Page not found.
         #   could do --> self.redirect('/404.html')
         handler.error(404)
-        view.ViewPage(cache_time=36000). \
+        permalink = handler.request.path.strip('/')
+        view.ViewPage(cache_time=36000,
+                      depends_on=['article:' + permalink]). \
              render(handler, {'module_name': 'blog', 
                               'handler_name': 'notfound'})
 
@@ -367,9 +415,11 @@ class UnauthorizedHandler(webapp.RequestHandler):
         view.ViewPage(cache_time=36000).render(self)
 
 class RootHandler(restful.Controller):
+    cache_query_params = ('limit', 'offset')
+
     def get(self):
         logging.debug("RootHandler#get")
-        page = view.ViewPage()
+        page = view.ViewPage(depends_on=['listing'])
         page.render_query(
             self, 'articles', 
             db.Query(models.blog.Article). \
@@ -381,9 +431,11 @@ class RootHandler(restful.Controller):
         process_article_submission(handler=self, article_type='article')
 
 class ArticlesHandler(restful.Controller):
+    cache_query_params = ('limit', 'offset')
+
     def get(self):
         logging.debug("ArticlesHandler#get")
-        page = view.ViewPage()
+        page = view.ViewPage(depends_on=['listing'])
         page.render_query(
             self, 'articles',
             db.Query(models.blog.Article). \
@@ -396,15 +448,17 @@ class ArticleHandler(restful.Controller):
     def get(self, path):
         logging.debug("ArticleHandler#get on path (%s)", path)
         # Handle precomputed legacy aliases
-        # TODO: Use hash for case-insensitive lookup
-        for alias in legacy_aliases.redirects:
-            if path.lower() == alias.lower():
-                self.redirect(legacy_aliases.redirects[alias])
-                return
+        if path.lower() in legacy_redirects:
+            self.redirect(legacy_redirects[path.lower()])
+            return
+
+        if memcache.get(not_found_key(path)):
+            logging.debug("Cached miss for path (%s)", path)
+            render_article(self, None)
+            return
 
         # Check undated pages
-        article = db.Query(models.blog.Article). \
-                     filter('permalink =', path).get()
+        article = models.blog.Article.get_by_permalink(path)
 
         if not article:
             # This lets you map arbitrary URL patterns like /node/3
@@ -414,11 +468,13 @@ class ArticleHandler(restful.Controller):
             if article and config.BLOG["legacy_entry_redirect"]:
                 self.redirect('/' + article.permalink)
                 return
+        if not article:
+            memcache.set(not_found_key(path), True, NOT_FOUND_CACHE_TIME)
         render_article(self, article)
 
     @restful.methods_via_query_allowed    
     def post(self, path):
-        article = db.Query(models.blog.Article).filter('permalink =', path).get()
+        article = models.blog.Article.get_by_permalink(path)
         process_comment_submission(self, article)
 
     @authorized.role("admin")
@@ -463,12 +519,11 @@ class ArticleHandler(restful.Controller):
             query = models.blog.Tag.all()
             delete_entity(query)
         else:
-            article = db.Query(models.blog.Article). \
-                         filter('permalink =', path).get()
-            for key in article.tag_keys:
-                db.get(key).counter.decrement()
+            article = models.blog.Article.get_by_permalink(path)
+            change_tag_counts(removed_keys=article.tag_keys)
             article.delete()
-            view.invalidate_cache()
+            view.invalidate_cache(['tags'] + 
+                                  view.article_dependencies(article))
             restful.send_successful_response(self, "/")
 
 # Blog entries are dated articles
@@ -477,17 +532,15 @@ class BlogEntryHandler(restful.Controller):
         logging.debug("BlogEntryHandler#get for year %s, "
                       "month %s, and perm_link %s", 
                       year, month, perm_stem)
-        article = db.Query(models.blog.Article). \
-                     filter('permalink =', 
-                            year + '/' + month + '/' + perm_stem).get()
+        article = models.blog.Article.get_by_permalink(
+                     year + '/' + month + '/' + perm_stem)
         render_article(self, article)
 
     @restful.methods_via_query_allowed    
     def post(self, year, month, perm_stem):
         logging.debug("Adding comment for blog entry %s", self.request.path)
         permalink = year + '/' + month + '/' + perm_stem
-        article = db.Query(models.blog.Article). \
-                     filter('permalink =', permalink).get()
+        article = models.blog.Article.get_by_permalink(permalink)
         if article:
             process_comment_submission(self, article)
         else:
@@ -504,18 +557,18 @@ class BlogEntryHandler(restful.Controller):
     def delete(self, year, month, perm_stem):
         permalink = year + '/' + month + '/' + perm_stem
         logging.debug("Deleting blog entry %s", permalink)
-        article = db.Query(models.blog.Article). \
-                     filter('permalink =', permalink).get()
-        for key in article.tag_keys:
-            db.get(key).counter.decrement()
+        article = models.blog.Article.get_by_permalink(permalink)
+        change_tag_counts(removed_keys=article.tag_keys)
         article.delete()
-        view.invalidate_cache()
+        view.invalidate_cache(['tags'] + view.article_dependencies(article))
         restful.send_successful_response(self, "/")
 
 class TagHandler(restful.Controller):
+    cache_query_params = ('limit', 'offset')
+
     def get(self, encoded_tag):
         tag = unicode(urllib.unquote(encoded_tag), config.BLOG["charset"])
-        page = view.ViewPage()
+        page = view.ViewPage(depends_on=['tag:' + tag])
         page.render_query(
             self, 'articles', 
             db.Query(models.blog.Article).filter('tags =',        
@@ -523,11 +576,13 @@ class TagHandler(restful.Controller):
                                                 {'tag': tag})
 
 class SearchHandler(restful.Controller):
+    cache_query_params = ('s', 'limit', 'offset')
+
     def get(self):
         from google.appengine.api import datastore_errors
         search_term = self.request.get("s")
         query_string = 's=' + urllib.quote_plus(search_term) + '&'
-        page = view.ViewPage()
+        page = view.ViewPage(depends_on=['listing'])
         try:
             page.render_query(
                 self, 'articles', 
@@ -542,11 +597,13 @@ class SearchHandler(restful.Controller):
                                """})
 
 class YearHandler(restful.Controller):
+    cache_query_params = ('limit', 'offset')
+
     def get(self, year):
         logging.debug("YearHandler#get for year %s", year)
         start_date = datetime.datetime(string.atoi(year), 1, 1)
         end_date = datetime.datetime(string.atoi(year), 12, 31, 23, 59, 59)
-        page = view.ViewPage()
+        page = view.ViewPage(depends_on=['archive:%d' % start_date.year])
         page.render_query(
             self, 'articles', 
             db.Query(models.blog.Article).order('-published'). \
@@ -555,13 +612,16 @@ class YearHandler(restful.Controller):
             {'title': 'Articles for ' + year, 'year': year})
 
 class MonthHandler(restful.Controller):
+    cache_query_params = ('limit', 'offset')
+
     def get(self, year, month):
         logging.debug("MonthHandler#get for year %s, month %s", year, month)
         start_date = datetime.datetime(string.atoi(year), 
                                        string.atoi(month), 1)
         end_date = datetime.datetime(string.atoi(year), 
                                      string.atoi(month), 31, 23, 59, 59)
-        page = view.ViewPage()
+        page = view.ViewPage(depends_on=['archive:%d/%d' % 
+                                         (start_date.year, start_date.month)])
         page.render_query(
             self, 'articles', 
             db.Query(models.blog.Article).order('-published'). \
@@ -588,7 +648,7 @@ class AtomHandler(webapp.RequestHandler):
             updated = articles[0].rfc3339_updated()
         
         self.response.headers['Content-Type'] = 'application/atom+xml'
-        page = view.ViewPage()
+        page = view.ViewPage(depends_on=['feed'])
         page.render(self, {"blog_updated_timestamp": updated, 
                            "articles": articles, "ext": "xml"})
 
@@ -598,7 +658,7 @@ class SitemapHandler(webapp.RequestHandler):
 		articles = db.Query(models.blog.Article).order('-published').fetch(1000)
 		if articles:
 			self.response.headers['Content-Type'] = 'text/xml'
-			page = view.ViewPage()
+			page = view.ViewPage(depends_on=['feed'])
 			page.render(self, {
           "articles": articles,
           "ext": "xml",
@@ -34,8 +34,12 @@ import os
 
 from google.appengine.api import memcache
 
+from google.appengine.api import users
+
 from handlers import restful
 from utils import authorized
+import models
+import models.blog
 import view
 
 class CacheStatsHandler(restful.Controller):
@@ -46,4 +50,19 @@ class CacheStatsHandler(restful.Controller):
 
     @authorized.role("admin")
     def delete(self):
+        # Tag counter changes are buffered in memcache.
+        models.blog.Tag.flush_counters()
         memcache.flush_all()
+
+class CounterFlushHandler(restful.Controller):
+    """Writes buffered counter changes that have gone idle and folds back
+    the shards of grown counters no longer written to.  Run by cron 
+    (see cron.yaml) so changes aren't left in memcache to be evicted."""
+    def get(self):
+        # App Engine strips this header from external requests.
+        if 'X-AppEngine-Cron' not in self.request.headers and \
+           not users.is_current_user_admin():
+            self.error(403)
+            return
+        models.blog.Tag.flush_counters()
+        models.Counter.consolidate_idle()
@@ -0,0 +1,72 @@
+# The MIT License
+# 
+# Copyright (c) 2008 William T. Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""
+migrate.py
+
+Moves articles stored under datastore ids to key names derived from
+their permalinks, so they can be fetched with get_by_key_name instead
+of a permalink query.  Each POST migrates one batch of articles and
+answers with the url for the next batch.  Keep posting to it until the
+response is a 204.
+"""
+import logging
+import string
+import urllib
+
+from google.appengine.ext import db
+
+from handlers import restful
+from utils import authorized
+import models.blog
+import view
+
+class PermalinkMigrationHandler(restful.Controller):
+    @authorized.role("admin")
+    def post(self):
+        limit = string.atoi(self.request.get("limit") or "20")
+        # Keys with ids sort before keys with names, so articles still
+        #  needing migration come first.  Articles that can't be migrated
+        #  are paged past with 'after'.
+        q = db.Query(models.blog.Article).order('__key__')
+        after = self.request.get("after")
+        if after:
+            q.filter('__key__ >', db.Key(after))
+        articles = [article for article in q.fetch(limit)
+                    if article.key().name() is None]
+        if not articles:
+            self.response.set_status(204, 'No more articles to migrate')
+            return
+        num_migrated = 0
+        for article in articles:
+            migrated = models.blog.migrate_article(article)
+            if migrated:
+                num_migrated += 1
+                # Cached pages embed a captcha derived from the old key.
+                view.invalidate_cache(view.article_dependencies(migrated))
+        logging.info("Migrated %d of %d articles to permalink key names",
+                     num_migrated, len(articles))
+        self.response.out.write('Migrated %d articles, next batch: %s?%s' % 
+            (num_migrated, self.request.path, 
+             urllib.urlencode({'limit': limit, 
+                               'after': str(articles[-1].key())})))
@@ -39,8 +39,12 @@ import time
 import urlparse
 import os
 
+from google.appengine.api import memcache
+
 from handlers import restful
+from handlers.bloog import warmer
 from utils import authorized
+from utils import template
 import view
 
 def start_run():
@@ -76,6 +80,11 @@ def stop_run(path):
             timing["max_time"] = elapsed_time
         timing["mutex_lock"] = False
 
+def ratio(hits, calls):
+    if calls > 0:
+        return 100.0 * hits / calls
+    return 0.0
+
 class TimingHandler(restful.Controller):
     @authorized.role("admin")
     def get(self):
@@ -85,19 +94,35 @@ class TimingHandler(restful.Controller):
         avg_speed = 0.0
         total_calls = 0
         total_full_renders = 0
+        total_stale_hits = 0
+        total_local_hits = 0
+        total_memcache_hits = 0
         for key in TIMINGS:
             
             full_renders = 0
             if key in view.NUM_FULL_RENDERS:
                 full_renders = view.NUM_FULL_RENDERS[key]
                 total_full_renders += full_renders
+            stale_hits = view.NUM_STALE_HITS.get(key, 0)
+            total_stale_hits += stale_hits
+            local_hits = view.NUM_LOCAL_HITS.get(key, 0)
+            total_local_hits += local_hits
+            memcache_hits = view.NUM_MEMCACHE_HITS.get(key, 0)
+            total_memcache_hits += memcache_hits
             url_timing = TIMINGS[key]
             if url_timing["runs"] > 0:
                 url_stats = url_timing.copy()
                 url_stats.update({'url': key,
                                   'avg_speed': url_timing["duration"] / 
                                                url_timing["runs"],
-                                  'full_renders': full_renders})
+                                  'full_renders': full_renders,
+                                  'stale_hits': stale_hits,
+                                  'local_hits': local_hits,
+                                  'memcache_hits': memcache_hits,
+                                  'local_ratio': ratio(local_hits,
+                                                       url_timing["runs"]),
+                                  'memcache_ratio': ratio(memcache_hits,
+                                                          url_timing["runs"])})
                 stats.append(url_stats)
                 total_time += url_timing["duration"]
                 total_calls += url_timing["runs"]
@@ -105,14 +130,57 @@ class TimingHandler(restful.Controller):
         
         if total_calls > 0:
             avg_speed = total_time / total_calls
+        route_keys = []
+        for route, seen in view.CACHE_KEYS.iteritems():
+            route_keys.append({'route': route, 
+                               'urls': len(seen['urls']),
+                               'keys': len(seen['keys'])})
+        template_stats = []
+        for name, template_timing in template.RENDER_TIMINGS.items():
+            if template_timing["runs"] > 0:
+                template_stats.append({
+                    'name': name,
+                    'runs': template_timing["runs"],
+                    'duration': template_timing["duration"],
+                    'self_duration': template_timing["self_duration"],
+                    'avg_speed': template_timing["duration"] / 
+                                 template_timing["runs"],
+                    'avg_self_speed': template_timing["self_duration"] /
+                                      template_timing["runs"],
+                    'max_time': template_timing["max_time"],
+                    'self_ratio': ratio(template_timing["self_duration"],
+                                        total_time)})
         view.ViewPage(cache_time=0).render(self, {"stats": stats, 
                                                   "avg_speed": avg_speed,
                                                   "total_time": total_time, 
                                                   "total_calls": total_calls,
                                                   "total_full_renders": 
-                                                     total_full_renders})
+                                                     total_full_renders,
+                                                  "total_stale_hits":
+                                                     total_stale_hits,
+                                                  "local_ratio":
+                                                     ratio(total_local_hits,
+                                                           total_calls),
+                                                  "memcache_ratio":
+                                                     ratio(total_memcache_hits,
+                                                           total_calls),
+                                                  "local_cache_bytes":
+                                                     view.LOCAL_CACHE.num_bytes,
+                                                  "local_cache_entries":
+                                                     len(view.LOCAL_CACHE),
+                                                  "fragment_renders":
+                                                     view.NUM_FRAGMENT_RENDERS,
+                                                  "route_keys": route_keys,
+                                                  "template_stats":
+                                                     template_stats,
+                                                  "max_tracked_keys":
+                                                     view.MAX_TRACKED_KEYS,
+                                                  "warming_reports":
+                                                     memcache.get(
+                                                       warmer.REPORTS_KEY)})
 
     @authorized.role("admin")
     def delete(self):
         global TIMINGS
-        TIMINGS = {}
\ No newline at end of file
+        TIMINGS = {}
+        template.RENDER_TIMINGS.clear()
\ No newline at end of file
@@ -0,0 +1,101 @@
+# The MIT License
+# 
+# Copyright (c) 2008 William T. Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+"""
+warmer.py
+
+Re-renders pages invalidated by a write so readers don't get the
+full-render latency.  Pages are fetched anonymously from the public url,
+which fills the page cache the same way a reader's request would.  If the
+task queue is available, fetching is done in a queued task; otherwise it
+is done at the end of the writing request.
+
+Also answers App Engine warmup requests for new instances by compiling
+all templates before the instance gets real traffic.
+"""
+
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import webapp
+try:
+    from google.appengine.api.labs import taskqueue
+except ImportError:
+    taskqueue = None
+
+import config
+import view
+
+WARM_URL = '/admin/warm_cache'
+REPORTS_KEY = 'CacheWarmingReports'
+MAX_REPORTS = 10
+
+def queue_warming(paths):
+    """Warms up to BLOG['warm_max_urls'] of the given paths."""
+    if not config.BLOG['cache_time']:
+        return
+    paths = paths[:config.BLOG['warm_max_urls']]
+    if not paths:
+        return
+    if taskqueue:
+        try:
+            taskqueue.add(url=WARM_URL, params={'path': paths})
+            return
+        except taskqueue.Error, e:
+            logging.warning("Couldn't queue cache warming: %s", e)
+    warm(paths)
+
+def warm(paths):
+    start_time = time.time()
+    num_warmed = 0
+    for path in paths:
+        try:
+            result = urlfetch.fetch(config.BLOG['root_url'] + path)
+            if result.status_code == 200:
+                num_warmed += 1
+        except urlfetch.Error, e:
+            logging.info("Couldn't warm %s: %s", path, e)
+    duration = time.time() - start_time
+    logging.info("Warmed %d of %d pages in %.3f s", 
+                 num_warmed, len(paths), duration)
+    reports = memcache.get(REPORTS_KEY) or []
+    reports.insert(0, {'finished': time.time(), 'urls': len(paths),
+                       'warmed': num_warmed, 'duration': duration})
+    memcache.set(REPORTS_KEY, reports[:MAX_REPORTS])
+
+class WarmHandler(webapp.RequestHandler):
+    def post(self):
+        # Only accept requests from our task queue.  App Engine strips
+        # this header from external requests.
+        if 'X-AppEngine-QueueName' not in self.request.headers:
+            self.error(403)
+            return
+        warm(self.request.get_all('path'))
+
+class InstanceWarmupHandler(webapp.RequestHandler):
+    def get(self):
+        start_time = time.time()
+        num_compiled = view.precompile_templates()
+        logging.info("Warmup compiled %d templates in %.3f s",
+                     num_compiled, time.time() - start_time)
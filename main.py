@@ -39,11 +39,13 @@ except:
     pass
 from google.appengine.ext import webapp
 from google.appengine.api import users
-from handlers.bloog import blog, contact, cache_stats, timings
+from handlers.bloog import blog, contact, cache_stats, timings, warmer
+from handlers.bloog import migrate
 
 # Import custom django libraries
 webapp.template.register_template_library('utils.django_libs.gravatar')
 webapp.template.register_template_library('utils.django_libs.description')
+webapp.template.register_template_library('utils.django_libs.cachedblock')
 
 # Log a message each time this module get loaded.
 logging.info('Loading %s, app version = %s',
@@ -58,6 +60,10 @@ ROUTES = [
     ('/([12]\d\d\d)/(\d|[01]\d)/([-\w]+)/*$', blog.BlogEntryHandler),
     ('/admin/cache_stats/*$', cache_stats.CacheStatsHandler),
     ('/admin/timings/*$', timings.TimingHandler),
+    ('/admin/flush_counters/*$', cache_stats.CounterFlushHandler),
+    (warmer.WARM_URL + '/*$', warmer.WarmHandler),
+    ('/_ah/warmup', warmer.InstanceWarmupHandler),
+    ('/admin/migrate_permalinks/*$', migrate.PermalinkMigrationHandler),
     ('/search', blog.SearchHandler),
     ('/contact/*$', contact.ContactHandler),
     ('/tag/(.*)', blog.TagHandler),
@@ -25,12 +25,14 @@ Extensions include:
 - Full-text searching with ability to hide properties from indexing
 - Counter implemented with sharding to improve write performance
 - Memcached aggregation of entities
-- Serialization of designated properties to json and repr formats.
+- Serialization of designated properties to json and compact pickled lists.
 """
 
+import cPickle
 import datetime
 import random
 import logging
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
@@ -68,69 +70,167 @@ def to_dict(model_obj, attr_list, init_dict_func=None):
 DATE_FORMAT = "%Y-%m-%d" 
 TIME_FORMAT = "%H:%M:%S"
 
-def replace_datastore_types(entity):
-    """Replaces any datastore types in a dictionary with standard types.
-    
-    Passed-in entities are assumed to be dictionaries with values that
-    can be at most a single list level.  These transformations are made:
-      datetime.datetime      -> string
-      db.Key                 -> key hash suitable for regenerating key
-      users.User             -> dict with 'nickname' and 'email'
-    TODO -- GeoPt when needed
+def user_to_json(user):
+    return { 'nickname': user.nickname(), 'email': user.email() }
+
+# Converts property values to JSON-friendly structures, looked up by the
+#  exact type of the value.  Unlisted types are passed through.
+JSON_CONVERTERS = {
+    datetime.datetime: 
+        lambda value: value.strftime("%s %s" % (DATE_FORMAT, TIME_FORMAT)),
+    datetime.date: lambda value: value.strftime(DATE_FORMAT),
+    datetime.time: lambda value: value.strftime(TIME_FORMAT),
+    datastore_types.Key: str,
+    users.User: user_to_json,
+}
+
+# Serializers built by get_json_serializer(), keyed by model class.
+json_serializers = {}
+
+def get_json_serializer(cls):
+    """Returns a function giving the JSON-friendly dict of a cls instance.
+
+    The function is built once per class from its properties, leaving out
+    json_does_not_include, and converts values through JSON_CONVERTERS:
+    dates and times to strings, keys to their string form and users to
+    dicts with 'nickname' and 'email'.
     """
-    def get_replacement(value):
-        if isinstance(value, datetime.datetime):
-            return value.strftime("%s %s" % (DATE_FORMAT, TIME_FORMAT))
-        elif isinstance(value, datetime.date):
-            return value.strftime(DATE_FORMAT)
-        elif isinstance(value, datetime.time):
-            return value.strftime(TIME_FORMAT)
-        elif isinstance(value, datastore_types.Key):
-            return str(value)
-        elif isinstance(value, users.User):
-            return { 'nickname': value.nickname(), 
-                     'email': value.email() }
-        else:
-            return None
+    serializer = json_serializers.get(cls)
+    if serializer is None:
+        getters = [(name, prop.get_value_for_datastore)
+                   for name, prop in cls.properties().iteritems()
+                   if name not in cls.json_does_not_include]
+        converters = JSON_CONVERTERS
+        def serializer(model_obj):
+            values = {}
+            for name, get_value in getters:
+                value = get_value(model_obj)
+                if isinstance(value, list):
+                    items = []
+                    for item in value:
+                        convert = converters.get(type(item))
+                        items.append(convert and convert(item) or item)
+                    value = items
+                else:
+                    convert = converters.get(type(value))
+                    if convert:
+                        value = convert(value)
+                values[name] = value
+            return values
+        json_serializers[cls] = serializer
+    return serializer
 
-    for key, value in entity.iteritems():
-        if isinstance(value, list):
-            new_list = []
-            for item in value:
-                new_value = get_replacement(item)
-                new_list.append(new_value or item)
-            entity[key] = new_list
-        else:
-            new_value = get_replacement(value)
-            if new_value:
-                entity[key] = new_value
+# Layout of the lists cached by MemcachedModel.list().  It's part of the
+#  memcache key, so bumping it leaves entries in the old layout unused.
+LIST_FORMAT = 2
+LIST_CHUNK_SIZE = 500       # Entities per cached chunk of a list.
+LIST_CHUNKS_PER_GET = 4     # Chunks fetched per memcache call.
+
+def pack_list(values_list):
+    """Packs a list of dicts sharing the same keys into a string.
+
+    The keys are stored once as a header and each dict as a tuple of
+    values, pickled with protocol 2, so unpack_list() does no parsing.
+    """
+    fields = []
+    if values_list:
+        fields = values_list[0].keys()
+    rows = [tuple([values.get(field) for field in fields]) 
+            for values in values_list]
+    return cPickle.dumps((LIST_FORMAT, fields, rows), 2)
+
+def unpack_list(data):
+    """Returns the list of dicts packed by pack_list()."""
+    list_format, fields, rows = cPickle.loads(data)
+    return [dict(zip(fields, row)) for row in rows]
 
 class SerializableModel(db.Model):
     """Extends Model to have json and possibly other serializations
     
     Use the class variable 'json_does_not_include' to declare properties
     that should *not* be included in json serialization.
+
+    Models with an 'updated' property have their json cached in memcache
+    for each value of 'updated'.  put() and delete() clear it.
     TODO -- Complete round-tripping
     """
     json_does_not_include = []
 
-    def to_json(self, attr_list=[]):
+    def delete(self):
+        json_key = self.json_cache_key()
+        super(SerializableModel, self).delete()
+        if json_key:
+            memcache.delete(json_key)
+
+    def put(self):
+        key = super(SerializableModel, self).put()
+        json_key = self.json_cache_key()
+        if json_key:
+            memcache.delete(json_key)
+        return key
+
+    def json_cache_key(self):
+        if 'updated' not in self.properties() or not self.is_saved() \
+           or self.updated is None:
+            return None
+        return 'JSON%s:%s' % (self.key(), self.updated.isoformat())
+
+    def to_json(self, attr_list=[], fields=None):
+        """Returns the model as json.  If a list of fields is given, only
+           those properties are included."""
+        json_key = None
+        if not attr_list and not fields:
+            json_key = self.json_cache_key()
+        if json_key:
+            json = memcache.get(json_key)
+            if json is not None:
+                return json
+        json = self.make_json(attr_list, fields)
+        if json_key:
+            memcache.set(json_key, json)
+        return json
+
+    def make_json(self, attr_list=[], fields=None):
+        """Serializes the model without going through the json cache."""
+        serializer = get_json_serializer(self.__class__)
         def to_entity(entity):
-            """Convert datastore types in entity to 
-               JSON-friendly structures."""
-            self._to_entity(entity)
-            for skipped_property in self.__class__.json_does_not_include:
-                del entity[skipped_property]
-            replace_datastore_types(entity)
+            entity.update(serializer(self))
         values = to_dict(self, attr_list, to_entity)
+        if fields:
+            values = dict([(field, values[field]) for field in fields 
+                           if field in values])
         return simplejson.dumps(values)
 
+def to_json_list(model_objs, fields=None):
+    """Returns the to_json() of each model, reading the cached ones with
+       one memcache call and caching the rest with another."""
+    json_keys = [None] * len(model_objs)
+    if not fields:
+        json_keys = [obj.json_cache_key() for obj in model_objs]
+    cached = memcache.get_multi([key for key in json_keys if key])
+    json_list = []
+    new_json = {}
+    for obj, json_key in zip(model_objs, json_keys):
+        json = cached.get(json_key)
+        if json is None:
+            json = obj.make_json(fields=fields)
+            if json_key:
+                new_json[json_key] = json
+        json_list.append(json)
+    if new_json:
+        memcache.set_multi(new_json)
+    return json_list
+
 class MemcachedModel(SerializableModel):
     """MemcachedModel adds memcached all() retrieval through list().
     
     It adds memcache clearing into Model methods, both class
     and instance, that alter the datastore.  For valid memcaching,
     you should use Model methods instead of lower-level db calls.
+
+    The list is cached in chunks of LIST_CHUNK_SIZE entities under a
+    manifest naming them.  Writes delete the manifest, which leaves
+    every chunk unreachable.
     
     Currently, this class does not care about failed attempts
     to alter the datastore, so uncompleted deletes and puts
@@ -147,9 +247,14 @@ class MemcachedModel(SerializableModel):
         memcache.delete(self.__class__.memcache_key())
         return key
 
-    def _to_repr(self):
-        return repr(to_dict(self, self.__class__.list_includes, 
-                    self._to_entity))
+    def _to_list_values(self):
+        return to_dict(self, self.__class__.list_includes, self._to_entity)
+
+    @classmethod
+    def list_values(cls, objs):
+        """Returns the list() entries for objs.  Override to fetch
+           values needed by every entry in one go."""
+        return [obj._to_list_values() for obj in objs]
 
     @classmethod
     def get_or_insert(cls, key_name, **kwds):
@@ -159,28 +264,78 @@ class MemcachedModel(SerializableModel):
 
     @classmethod
     def memcache_key(cls):
-        return 'PS_' + cls.__name__ + '_ALL'
+        return 'PS%d_%s_ALL' % (LIST_FORMAT, cls.__name__)
+
+    @classmethod
+    def chunk_key(cls, manifest, index):
+        return '%s:%s:%d' % (cls.memcache_key(), manifest['id'], index)
 
-    # TODO -- Verify security issues involved with eval of repr.
-    #  Since in Bloog, only admin is creating tags, not an issue,
-    #  but consider possible security issues with injection
-    #  of user data.
-    # TODO -- Break this up so we won't trip quota on huge lists.
     @classmethod
     def list(cls, nocache=False):
-        """Returns a list of up to 1000 dicts of model values.
+        """Returns a list of dicts of model values.
            Unless nocache is set to True, memcache will be checked first.
         Returns:
           List of dicts with each dict holding an entities property names
           and values.
         """
-        list_repr = memcache.get(cls.memcache_key())
-        if nocache or list_repr is None:
-            q = db.Query(cls)
-            objs = q.fetch(limit=1000)
-            list_repr = '[' + ','.join([obj._to_repr() for obj in objs]) + ']'
-            memcache.set(cls.memcache_key(), list_repr)
-        return eval(list_repr)
+        return list(cls.iter_list(nocache))
+
+    @classmethod
+    def iter_list(cls, nocache=False):
+        """Yields the dicts of list(), fetching cached chunks only as
+           they're reached.  If a chunk has been evicted, the whole list
+           is rebuilt and iteration carries on from the rebuilt chunks.
+        """
+        manifest = None
+        if not nocache:
+            manifest = memcache.get(cls.memcache_key())
+        chunks = None
+        if manifest is None:
+            manifest, chunks = cls.build_list()
+        index = 0
+        while index < manifest['num_chunks']:
+            if chunks is None:
+                last = min(index + LIST_CHUNKS_PER_GET, manifest['num_chunks'])
+                keys = [cls.chunk_key(manifest, i) for i in range(index, last)]
+                found = memcache.get_multi(keys)
+                if len(found) < len(keys):
+                    manifest, chunks = cls.build_list()
+                    continue
+                batch = [found[key] for key in keys]
+            else:
+                batch = chunks[index:index + LIST_CHUNKS_PER_GET]
+            for chunk in batch:
+                for values in unpack_list(chunk):
+                    yield values
+            index += len(batch)
+
+    @classmethod
+    def build_list(cls):
+        """Packs all entities, in key order, into chunks and caches them
+           under a new manifest.
+        Returns:
+          Tuple of the manifest and the list of packed chunks.
+        """
+        chunks = []
+        q = db.Query(cls).order('__key__')
+        objs = q.fetch(LIST_CHUNK_SIZE)
+        while objs:
+            chunks.append(pack_list(cls.list_values(objs)))
+            if len(objs) < LIST_CHUNK_SIZE:
+                break
+            q = db.Query(cls).order('__key__')
+            q.filter('__key__ >', objs[-1].key())
+            objs = q.fetch(LIST_CHUNK_SIZE)
+        manifest = {'id': '%d.%d' % (time.time() * 1000, 
+                                     random.randint(0, 9999)),
+                    'num_chunks': len(chunks)}
+        mapping = {}
+        for index, chunk in enumerate(chunks):
+            mapping[cls.chunk_key(manifest, index)] = chunk
+        # Only publish the manifest once all of its chunks are cached.
+        if not memcache.set_multi(mapping):
+            memcache.set(cls.memcache_key(), manifest)
+        return manifest, chunks
 
 class Counter(object):
     """A counter using sharded writes to prevent contentions.
@@ -192,19 +347,61 @@ class Counter(object):
     Memcache is used for caching counts, although you can force
     non-cached counts.
 
+    A buffered counter keeps changes as a pending delta in memcache and
+    writes them to a shard in one transaction, once flush_deltas changes
+    have piled up or on the first change after flush_interval seconds.
+    Pending changes are lost if memcache evicts them before a flush.
+
+    Shard writes of unbuffered counters that need transaction retries,
+    or fail, are counted.  A counter that hits GROW_CONTENTION of them
+    within CONTENTION_WINDOW seconds doubles its shards, up to 
+    MAX_SHARDS.  The grown shard count is kept in a CounterConfig entity.
+    consolidate_idle(), run from cron, folds the extra shards back once
+    none of them has been written for CONSOLIDATE_IDLE seconds.  Buffered
+    counters only write from flush(), one flush at a time, so they don't
+    contend and keep num_shards.
+
+    Uncached counts start from a CounterSnapshot of the shards, so they
+    only read the snapshot and the shards updated since it was taken.
+    Snapshots are retaken once they're SNAPSHOT_AGE seconds old.
+
     Usage:
         hits = Counter('hits')
         hits.increment()
         hits.get_count()
         hits.get_count(nocache=True)  # Forces non-cached count.
         hits.decrement()
+        views = Counter('views', buffered=True)
+        views.increment()
+        views.get_count(flush=True)   # Writes pending changes first.
     """
     MAX_SHARDS = 50
+    KEY_PREFIX = 'Counter'
+    SHARDS_PREFIX = 'CounterShards'
+    CONTENTION_WINDOW = 60      # Seconds over which contention is counted.
+    GROW_CONTENTION = 3         # Contended writes in a window that make
+                                #  a counter double its shards.
+    CONSOLIDATE_IDLE = 1800     # Seconds without shard writes before a
+                                #  grown counter is consolidated.
+    SNAPSHOT_AGE = 600          # Seconds before a snapshot is retaken.
+    SNAPSHOT_SKEW = 5           # Seconds of clock skew allowed between
+                                #  a snapshot and shard updates.
+    PENDING_PREFIX = 'CounterPending'
+    FLUSH_PREFIX = 'CounterFlush'
+    PENDING_BASE = 2 ** 32      # Memcache counters can't go negative, so
+                                #  pending deltas are offset by this.
+    MAX_KEYS_PER_GET = 1000     # Most keys the datastore takes in one
+                                #  batch get.
 
-    def __init__(self, name, num_shards=5, cache_time=30):
+    def __init__(self, name, num_shards=5, cache_time=30, buffered=False,
+                 flush_deltas=20, flush_interval=60):
         self.name = name
+        # Fewest shards used.  See get_num_shards() for the current count.
         self.num_shards = min(num_shards, Counter.MAX_SHARDS)
         self.cache_time = cache_time
+        self.buffered = buffered
+        self.flush_deltas = flush_deltas
+        self.flush_interval = flush_interval
 
     def delete(self):
         q = db.Query(CounterShard).filter('name =', self.name)
@@ -213,18 +410,293 @@ class Counter(object):
         shards = q.fetch(limit=Counter.MAX_SHARDS)
         for shard in shards:
             shard.delete()
+        config = CounterConfig.get_by_key_name(
+                    CounterConfig.get_key_name(self.name))
+        if config:
+            config.delete()
+        snapshot = CounterSnapshot.get_by_key_name(
+                    CounterSnapshot.get_key_name(self.name))
+        if snapshot:
+            snapshot.delete()
+        memcache.delete_multi([self.pending_key(), self.flush_key(),
+                               self.shards_key(), self.contention_key()])
 
     def memcache_key(self):
-        return 'Counter' + self.name
+        return Counter.KEY_PREFIX + self.name
+
+    def pending_key(self):
+        return Counter.PENDING_PREFIX + self.name
+
+    def shards_key(self):
+        return Counter.SHARDS_PREFIX + self.name
+
+    def contention_key(self):
+        return 'CounterContention' + self.name
+
+    def get_num_shards(self):
+        """Returns the number of shards currently written to."""
+        num_shards = memcache.get(self.shards_key())
+        if num_shards is None:
+            config = CounterConfig.get_by_key_name(
+                        CounterConfig.get_key_name(self.name))
+            num_shards = self.num_shards
+            if config:
+                num_shards = max(config.num_shards, self.num_shards)
+            memcache.add(self.shards_key(), num_shards)
+        return num_shards
+
+    def set_num_shards(self, num_shards):
+        CounterConfig(key_name=CounterConfig.get_key_name(self.name),
+                      name=self.name, base_shards=self.num_shards,
+                      num_shards=num_shards).put()
+        memcache.set(self.shards_key(), num_shards)
+
+    def write_shard(self, downward=False, amount=1):
+        """Changes a random shard, growing the shard count if writes to
+           this counter keep contending."""
+        num_shards = self.get_num_shards()
+        attempts = CounterShard.increment(self.name, num_shards, 
+                                          downward=downward, amount=amount)
+        if attempts != 1 and not self.buffered:
+            self.record_contention(num_shards)
+        return attempts
+
+    def record_contention(self, num_shards):
+        key = self.contention_key()
+        memcache.add(key, '0', Counter.CONTENTION_WINDOW)
+        num_contended = memcache.incr(key)
+        if num_contended >= Counter.GROW_CONTENTION and \
+           num_shards < Counter.MAX_SHARDS:
+            num_shards = min(num_shards * 2, Counter.MAX_SHARDS)
+            logging.info("Counter %s contended, growing to %d shards",
+                         self.name, num_shards)
+            self.set_num_shards(num_shards)
+            memcache.set(key, '0', Counter.CONTENTION_WINDOW)
+
+    def consolidate(self):
+        """Folds shards above num_shards back into the first num_shards,
+           so uncached reads fetch fewer entities.
+
+        Meant for idle counters (see consolidate_idle).  Changes made to
+        a shard while it's being folded are kept, but a failure between a
+        shard's two transactions counts it twice.
+        """
+        config = CounterConfig.get_by_key_name(
+                    CounterConfig.get_key_name(self.name))
+        if config:
+            config.delete()
+        memcache.set(self.shards_key(), self.num_shards)
+        q = db.Query(CounterShard).filter('name =', self.name)
+        for shard in q.fetch(limit=Counter.MAX_SHARDS):
+            if shard.get_index() <= self.num_shards:
+                continue
+            amount = shard.count
+            if amount and not CounterShard.increment(self.name, 
+                                                     self.num_shards,
+                                                     downward=amount < 0,
+                                                     amount=abs(amount)):
+                continue
+            CounterShard.drain(shard.key().name(), amount)
+        # Snapshots only notice updated shards, not deleted ones.
+        self.take_snapshot()
+
+    def take_snapshot(self):
+        """Sums all shards into a new CounterSnapshot and returns it."""
+        start_time = time.time()
+        key_name = CounterSnapshot.get_key_name(self.name)
+        old_snapshot = CounterSnapshot.get_by_key_name(key_name)
+        # Taken before reading so shards written meanwhile count as updated.
+        taken = datetime.datetime.now()
+        q = db.Query(CounterShard).filter('name =', self.name)
+        shards = q.fetch(limit=Counter.MAX_SHARDS)
+        shard_counts = [0] * max([0] + [shard.get_index() 
+                                        for shard in shards])
+        for shard in shards:
+            shard_counts[shard.get_index() - 1] = shard.count
+        version = 1
+        if old_snapshot:
+            version = old_snapshot.version + 1
+        snapshot = CounterSnapshot(key_name=key_name, 
+                                   count=sum(shard_counts),
+                                   shard_counts=shard_counts,
+                                   version=version, taken=taken,
+                                   refresh_time=time.time() - start_time)
+        snapshot.put()
+        logging.debug("Counter %s snapshot %d of %d shards took %.3f secs",
+                      self.name, version, len(shards), 
+                      snapshot.refresh_time)
+        return snapshot
+
+    def get_shards_count(self):
+        """Returns the sum of all shards, reading them through the
+           counter's snapshot."""
+        snapshot = CounterSnapshot.get_by_key_name(
+                    CounterSnapshot.get_key_name(self.name))
+        age = datetime.timedelta(seconds=Counter.SNAPSHOT_AGE)
+        if snapshot is None or \
+           snapshot.taken < datetime.datetime.now() - age:
+            return self.take_snapshot().count
+        since = snapshot.taken - \
+                datetime.timedelta(seconds=Counter.SNAPSHOT_SKEW)
+        q = db.Query(CounterShard).filter('name =', self.name)
+        q.filter('updated >=', since)
+        total = snapshot.count
+        for shard in q.fetch(limit=Counter.MAX_SHARDS):
+            total += shard.count - snapshot.get_shard_count(shard.get_index())
+        return total
+
+    def flush_key(self):
+        """Holds the number of changes since the last flush, and expires 
+           flush_interval seconds after it."""
+        return Counter.FLUSH_PREFIX + self.name
+
+    def get_pending(self):
+        pending = memcache.get(self.pending_key())
+        if pending is None:
+            return 0
+        return int(pending) - Counter.PENDING_BASE
+
+    def add_pending(self, delta):
+        key = self.pending_key()
+        memcache.add(key, str(Counter.PENDING_BASE))
+        if delta > 0:
+            memcache.incr(key, delta)
+        else:
+            memcache.decr(key, -delta)
+
+    def flush(self):
+        """Writes the pending delta of a buffered counter to a shard."""
+        lock_key = 'CounterFlushLock' + self.name
+        if not memcache.add(lock_key, 1, 30):
+            return False
+        try:
+            memcache.set(self.flush_key(), '0', self.flush_interval)
+            delta = self.get_pending()
+            if not delta:
+                return True
+            if not self.write_shard(downward=delta < 0, amount=abs(delta)):
+                return False
+            # Changes made since get_pending() stay pending.
+            self.add_pending(-delta)
+            return True
+        finally:
+            memcache.delete(lock_key)
+
+    @classmethod
+    def get_counts(cls, names, num_shards=5, cache_time=30, nocache=False,
+                   buffered=False):
+        """Returns a dict of counts keyed by counter name.
+
+        Cached counts are read with one memcache call.  The shards of
+        the rest are fetched by key name in datastore gets of up to
+        MAX_KEYS_PER_GET keys, after looking up how many shards each has.  For buffered counters,
+        their pending deltas are read with one more memcache call.
+        """
+        counts = {}
+        if not nocache:
+            cached = memcache.get_multi(names, key_prefix=Counter.KEY_PREFIX)
+            for name, total in cached.iteritems():
+                counts[name] = int(total)
+        missing = [name for name in names if name not in counts]
+        if missing:
+            shard_counts = cls.get_shard_counts(missing, num_shards)
+            key_names = []
+            for name in missing:
+                counts[name] = 0
+                for index in range(1, shard_counts[name] + 1):
+                    key_names.append(CounterShard.get_key_name(name, index))
+            for start in range(0, len(key_names), Counter.MAX_KEYS_PER_GET):
+                shards = CounterShard.get_by_key_name(
+                            key_names[start:start + Counter.MAX_KEYS_PER_GET])
+                for shard in shards:
+                    if shard is not None:
+                        counts[shard.name] += shard.count
+            if buffered:
+                pending = memcache.get_multi(missing, 
+                                             key_prefix=Counter.PENDING_PREFIX)
+                for name, delta in pending.iteritems():
+                    counts[name] += int(delta) - Counter.PENDING_BASE
+                cls.flush_stale([name for name, delta in pending.iteritems()
+                                 if int(delta) != Counter.PENDING_BASE],
+                                num_shards)
+            memcache.add_multi(dict([(name, str(counts[name])) 
+                                     for name in missing]),
+                               time=cache_time, 
+                               key_prefix=Counter.KEY_PREFIX)
+        return counts
+
+    @classmethod
+    def get_shard_counts(cls, names, num_shards=5):
+        """Returns a dict of get_num_shards() keyed by counter name."""
+        num_shards = min(num_shards, Counter.MAX_SHARDS)
+        shard_counts = memcache.get_multi(names, 
+                                          key_prefix=Counter.SHARDS_PREFIX)
+        missing = [name for name in names if name not in shard_counts]
+        if missing:
+            configs = CounterConfig.get_by_key_name(
+                        [CounterConfig.get_key_name(name) for name in missing])
+            for name, config in zip(missing, configs):
+                shard_counts[name] = num_shards
+                if config:
+                    shard_counts[name] = max(config.num_shards, num_shards)
+            memcache.add_multi(dict([(name, shard_counts[name]) 
+                                     for name in missing]),
+                               key_prefix=Counter.SHARDS_PREFIX)
+        return shard_counts
+
+    @classmethod
+    def consolidate_idle(cls, idle_time=None):
+        """Consolidates each grown counter none of whose shards has been
+           written in the last idle_time seconds (CONSOLIDATE_IDLE by
+           default).  Returns the names of the consolidated counters."""
+        if idle_time is None:
+            idle_time = Counter.CONSOLIDATE_IDLE
+        since = datetime.datetime.now() - \
+                datetime.timedelta(seconds=idle_time)
+        names = []
+        for config in CounterConfig.all():
+            if config.num_shards <= config.base_shards:
+                continue
+            q = db.Query(CounterShard).filter('name =', config.name)
+            if q.filter('updated >=', since).get() is None:
+                Counter(config.name, config.base_shards).consolidate()
+                names.append(config.name)
+        return names
+
+    @classmethod
+    def flush_pending(cls, names, num_shards=5):
+        """Flushes the buffered counters among names that have changes
+           pending, reading their deltas with one memcache call."""
+        if not names:
+            return
+        pending = memcache.get_multi(names, key_prefix=Counter.PENDING_PREFIX)
+        for name, delta in pending.iteritems():
+            if int(delta) != Counter.PENDING_BASE:
+                Counter(name, num_shards, buffered=True).flush()
+
+    @classmethod
+    def flush_stale(cls, names, num_shards=5):
+        """Flushes the buffered counters among names whose changes have 
+           been pending for more than their flush_interval."""
+        if not names:
+            return
+        windows = memcache.get_multi(names, key_prefix=Counter.FLUSH_PREFIX)
+        for name in names:
+            if name not in windows:
+                Counter(name, num_shards, buffered=True).flush()
 
-    def get_count(self, nocache=False):
+    def get_count(self, nocache=False, flush=False):
+        if flush and self.buffered:
+            self.flush()
         total = memcache.get(self.memcache_key())
         if nocache or total is None:
-            total = 0
-            q = db.Query(CounterShard).filter('name =', self.name)  
-            shards = q.fetch(limit=Counter.MAX_SHARDS)
-            for shard in shards:
-                total += shard.count
+            if self.buffered and not flush and \
+               memcache.get(self.flush_key()) is None:
+                # Changes left pending past flush_interval.
+                self.flush()
+            total = self.get_shards_count()
+            if self.buffered:
+                total += self.get_pending()
             memcache.add(self.memcache_key(), str(total), 
                          self.cache_time)
             return total
@@ -234,37 +706,112 @@ class Counter(object):
     count = property(get_count)
 
     def increment(self):
-        CounterShard.increment(self.name, self.num_shards)
+        if self.buffered:
+            self.buffer_change(1)
+        else:
+            self.write_shard()
         return memcache.incr(self.memcache_key()) 
 
     def decrement(self):
-        CounterShard.increment(self.name, self.num_shards, 
-                               downward=True)
+        if self.buffered:
+            self.buffer_change(-1)
+        else:
+            self.write_shard(downward=True)
         return memcache.decr(self.memcache_key()) 
 
+    def buffer_change(self, delta):
+        self.add_pending(delta)
+        num_changes = memcache.incr(self.flush_key())
+        # No count means flush_interval has passed since the last flush.
+        if num_changes is None or num_changes >= self.flush_deltas:
+            self.flush()
+
 class CounterShard(db.Model):
     name = db.StringProperty(required=True)
     count = db.IntegerProperty(default=0)
+    updated = db.DateTimeProperty(auto_now=True)
 
     @classmethod
-    def increment(cls, name, num_shards, downward=False):
+    def get_key_name(cls, name, index):
+        return 'Shard' + name + str(index)
+
+    def get_index(self):
+        prefix = CounterShard.get_key_name(self.name, '')
+        return int(self.key().name()[len(prefix):])
+
+    @classmethod
+    def increment(cls, name, num_shards, downward=False, amount=1):
+        """Changes a random shard of the named counter.
+
+        Returns:
+          The number of attempts the transaction took, or 0 if it failed.
+        """
         index = random.randint(1, num_shards)
-        shard_key_name = 'Shard' + name + str(index)
+        shard_key_name = cls.get_key_name(name, index)
+        attempts = []
         def get_or_create_shard():
+            attempts.append(1)
             shard = CounterShard.get_by_key_name(shard_key_name)
             if shard is None:
                 shard = CounterShard(key_name=shard_key_name, 
                                      name=name)
             if downward:
-                shard.count -= 1
+                shard.count -= amount
             else:
-                shard.count += 1
+                shard.count += amount
             key = shard.put()
         try:
             db.run_in_transaction(get_or_create_shard)
-            return True
-        except db.TransactionFailedError():
+            return len(attempts)
+        except db.TransactionFailedError:
             logging.error("CounterShard (%s, %d) - can't increment", 
                           name, num_shards)
+            return 0
+
+    @classmethod
+    def drain(cls, shard_key_name, amount):
+        """Takes amount off a shard, deleting it if nothing is left."""
+        def drain_shard():
+            shard = CounterShard.get_by_key_name(shard_key_name)
+            if shard is None:
+                return
+            shard.count -= amount
+            if shard.count:
+                shard.put()
+            else:
+                shard.delete()
+        try:
+            db.run_in_transaction(drain_shard)
+            return True
+        except db.TransactionFailedError:
+            logging.error("CounterShard %s - can't drain", shard_key_name)
             return False
 
+class CounterSnapshot(db.Model):
+    """Shard counts of a counter as of a given time.  See Counter."""
+    count = db.IntegerProperty(default=0)
+    shard_counts = db.ListProperty(int)     # Indexed by shard index - 1.
+    version = db.IntegerProperty(default=1)
+    taken = db.DateTimeProperty(required=True)
+    refresh_time = db.FloatProperty()       # Seconds taken to sum shards.
+
+    @classmethod
+    def get_key_name(cls, name):
+        return 'Snapshot' + name
+
+    def get_shard_count(self, index):
+        if index <= len(self.shard_counts):
+            return self.shard_counts[index - 1]
+        return 0
+
+class CounterConfig(db.Model):
+    """Current shard count of a counter, grown under contention.  Only
+       kept while the counter has more than its base_shards."""
+    name = db.StringProperty()
+    base_shards = db.IntegerProperty(default=1)
+    num_shards = db.IntegerProperty(default=1)
+
+    @classmethod
+    def get_key_name(cls, name):
+        return 'Config' + name
+
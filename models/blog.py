@@ -78,6 +78,38 @@ class Article(search.SearchableModel):
     # This lets us choose the proper javascript for pretty viewing.
     embedded_code = db.StringListProperty()
 
+    # New articles are stored under a key name derived from their
+    #  permalink so they can be fetched without a query.  Older ones are
+    #  found by query until migrate_article() moves them, and their keys
+    #  are remembered in memcache.
+    @classmethod
+    def get_key_name(cls, permalink):
+        return 'permalink:' + permalink
+
+    @classmethod
+    def permalink_memcache_key(cls, permalink):
+        return 'Permalink:' + permalink
+
+    @classmethod
+    def get_by_permalink(cls, permalink):
+        article = cls.get_by_key_name(cls.get_key_name(permalink))
+        if article:
+            return article
+        memcache_key = cls.permalink_memcache_key(permalink)
+        key = memcache.get(memcache_key)
+        if key:
+            article = db.get(key)
+            if article and article.permalink == permalink:
+                return article
+        article = db.Query(cls).filter('permalink =', permalink).get()
+        if article:
+            memcache.set(memcache_key, str(article.key()))
+        return article
+
+    def delete(self):
+        super(Article, self).delete()
+        memcache.delete(Article.permalink_memcache_key(self.permalink))
+
     def get_comments(self):
         """Return comments lexicographically sorted on thread string"""
         q = db.GqlQuery("SELECT * FROM Comment " +
@@ -134,6 +166,44 @@ class Article(search.SearchableModel):
         import re
         return re.sub('&(?!amp;)', '&amp;', self.html)
 
+def migrate_article(article):
+    """Moves an article stored under an id to its permalink key name,
+    pointing its comments at the new entity.
+
+    If a copy under the key name is left from an interrupted migration,
+    the move is finished onto that copy.
+
+    Returns:
+      The migrated article, or None if it was already migrated or a
+      different article holds its key name.
+    """
+    key_name = Article.get_key_name(article.permalink)
+    if article.key().name() == key_name:
+        return None
+    migrated = Article.get_by_key_name(key_name)
+    if migrated is None:
+        values = dict([(name, getattr(article, name)) 
+                       for name in Article.properties()])
+        migrated = Article(key_name=key_name, **values)
+        migrated.put()
+    elif migrated.title != article.title or \
+         migrated.published != article.published:
+        logging.warning("Can't migrate article %s: permalink %s is taken",
+                        article.key(), article.permalink)
+        return None
+    # Re-pointed comments drop out of the query, so keep fetching
+    #  until none are left.
+    while True:
+        comments = db.Query(Comment).filter('article =', 
+                                            article.key()).fetch(100)
+        if not comments:
+            break
+        for comment in comments:
+            comment.article = migrated
+        db.put(comments)
+    article.delete()
+    return migrated
+
 class Comment(models.SerializableModel):
     """Stores comments and their position in comment threads.
 
@@ -172,14 +242,43 @@ class Comment(models.SerializableModel):
 
 class Tag(models.MemcachedModel):
     # Inserts these values into aggregate list returned by Tag.list()
-    list_includes = ['counter.count', 'name']
+    #  along with 'count' (see list_values).
+    list_includes = ['name']
+
+    @classmethod
+    def list_values(cls, tags):
+        """Reads the counters of all tags at once."""
+        counter_names = ['Tag' + tag.name for tag in tags]
+        counts = models.Counter.get_counts(counter_names, buffered=True)
+        values_list = []
+        for tag, counter_name in zip(tags, counter_names):
+            values = tag._to_list_values()
+            values['count'] = counts[counter_name]
+            values_list.append(values)
+        return values_list
 
     def delete(self):
         self.delete_counter()
         super(Tag, self).delete()
 
+    @classmethod
+    def flush_counters(cls):
+        """Writes the pending changes of every tag counter, e.g. before
+           memcache is flushed.  Only counters with changes pending are
+           flushed, a batch of tags at a time."""
+        q = db.Query(cls).order('__key__')
+        tags = q.fetch(models.LIST_CHUNK_SIZE)
+        while tags:
+            models.Counter.flush_pending(['Tag' + tag.name for tag in tags])
+            if len(tags) < models.LIST_CHUNK_SIZE:
+                break
+            q = db.Query(cls).order('__key__')
+            q.filter('__key__ >', tags[-1].key())
+            tags = q.fetch(models.LIST_CHUNK_SIZE)
+
     def get_counter(self):
-        counter = models.Counter('Tag' + self.name)
+        # Buffered so saving an article doesn't run a transaction per tag.
+        counter = models.Counter('Tag' + self.name, buffered=True)
         return counter
 
     def set_counter(self, value):
@@ -187,7 +286,7 @@ class Tag(models.MemcachedModel):
         pass
 
     def delete_counter(self):
-        models.Counter('Tag' + self.name).delete()
+        models.Counter('Tag' + self.name, buffered=True).delete()
 
     counter = property(get_counter, set_counter, delete_counter)
 
@@ -0,0 +1,69 @@
+# The MIT License
+# 
+# Copyright (c) 2008 Matteo Crippa
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""
+Fragment caching for Bloog templates
+
+  {% cachedblock tags %} ... {% endcachedblock %}
+  {% cachedblock navlinks 86400 %} ... {% endcachedblock %}
+
+The rendered block is cached under its name and the generation of the
+cache family of the same name (see view.get_fragment), so
+view.invalidate_cache(['tags']) refreshes just that fragment.  An optional
+second argument sets the fragment's cache time in seconds.
+"""
+
+import django.template
+from google.appengine.ext import webapp
+
+register = webapp.template.create_template_register()
+
+class CachedBlockNode(django.template.Node):
+    def __init__(self, name, cache_time, nodelist):
+        self.name = name
+        self.cache_time = cache_time
+        self.nodelist = nodelist
+
+    def render(self, context):
+        import view         # view imports the template machinery
+        return view.get_fragment(self.name, 
+                                 lambda: self.nodelist.render(context),
+                                 self.cache_time)
+
+def cachedblock(parser, token):
+    bits = token.contents.split()
+    if len(bits) not in (2, 3):
+        raise django.template.TemplateSyntaxError(
+            "'%s' takes a fragment name and an optional cache time" % bits[0])
+    cache_time = None
+    if len(bits) == 3:
+        try:
+            cache_time = int(bits[2])
+        except ValueError:
+            raise django.template.TemplateSyntaxError(
+                "'%s' cache time must be an integer" % bits[0])
+    nodelist = parser.parse(('endcachedblock',))
+    parser.delete_first_token()
+    return CachedBlockNode(bits[1], cache_time, nodelist)
+
+register.tag(cachedblock)
@@ -0,0 +1,96 @@
+# The MIT License
+# 
+# Copyright (c) 2008 William T. Katz
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to 
+# deal in the Software without restriction, including without limitation 
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, 
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER 
+# DEALINGS IN THE SOFTWARE.
+
+
+"""
+lru_cache.py
+
+A per-process cache bounded by the total size of its values rather than
+by the number of entries.  Least recently used entries are evicted first.
+Like the other module globals on App Engine, contents only live as long as
+the current instance and aren't shared between instances.
+"""
+
+class LRUCache(object):
+    """
+    Maps keys to values, evicting least recently used entries once
+    the summed sizes of the values go over max_bytes.
+
+    Usage:
+        cache = LRUCache(4 * 1024 * 1024)
+        cache.set('key', value, len(value))
+        cache.get('key')      # Returns None if missing.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = {}
+        # Circular doubly-linked list of [prev, next, key, value, size]
+        # with the most recently used entry right after the root.
+        self.root = [None, None, None, None, 0]
+        self.root[0] = self.root[1] = self.root
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _push_front(self, link):
+        first = self.root[1]
+        link[0] = self.root
+        link[1] = first
+        first[0] = link
+        self.root[1] = link
+
+    def get(self, key):
+        link = self.entries.get(key)
+        if link is None:
+            return None
+        self._unlink(link)
+        self._push_front(link)
+        return link[3]
+
+    def set(self, key, value, size):
+        self.delete(key)
+        if size > self.max_bytes:
+            return False
+        link = [None, None, key, value, size]
+        self._push_front(link)
+        self.entries[key] = link
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            self.delete(self.root[0][2])
+        return True
+
+    def delete(self, key):
+        link = self.entries.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+            self.num_bytes -= link[4]
+
+    def clear(self):
+        self.entries = {}
+        self.num_bytes = 0
+        self.root[0] = self.root[1] = self.root
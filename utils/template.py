@@ -20,6 +20,11 @@
 Note: This code is slightly altered from google.appengine.ext.webapp.
 Changes by Bill Katz on original:
   - Allow setting of template directory hierarchy in render() and load()
+  - Cache compiled templates by path and template directories
+  - Bind template directories to each compiled template instead of
+    swapping Django settings on every render
+  - Add stream() to write a template's output in chunks
+  - Keep render timings per template name in RENDER_TIMINGS
 
 The main purpose of this module is to hide all of the package import pain
 you normally have to go through to get Django to work. We expose the Django
@@ -33,10 +38,11 @@ Typical usage:
 
 Django uses a global setting for the directory in which it looks for templates.
 This is not natural in the context of the webapp module, so our load method
-takes in a complete template path, and we set these settings on the fly
-automatically.  Because we have to set and use a global setting on every
-method call, this module is not thread safe, though that is not an issue
-for applications.
+takes in a complete template path and template directories.  The directories
+are kept with each compiled template and handed to our template loader
+through a thread-local while it renders, so templates pulled in at render
+time ({% extends %}, {% include %}) are found without touching global
+settings.  Debug settings are only swapped in when debug=True.
 
 Django template documentation is available at:
 http://www.djangoproject.com/documentation/templates/
@@ -45,6 +51,8 @@ http://www.djangoproject.com/documentation/templates/
 
 import logging
 import os
+import threading
+import time
 
 try:
   from django import v0_96
@@ -65,9 +73,40 @@ except (EnvironmentError, RuntimeError):
   pass
 import django.template
 import django.template.loader
+import django.template.loader_tags
+from django.template.loaders import filesystem
 
 from google.appengine.ext import webapp
 
+# Template directories bound to the template being loaded or rendered
+# on the current thread.
+_bound = threading.local()
+
+# Render timings keyed by template name, including templates pulled in by
+# {% include %} and {% extends %}.  'duration' covers nested templates
+# while 'self_duration' leaves them out.  Like the timings module, this
+# only holds stats for the current instance.
+RENDER_TIMINGS = {}
+
+# Child render time for each template being rendered on this thread.
+_profile = threading.local()
+
+def load_template_source(template_name, template_dirs=None):
+  """Django template loader using the current thread's bound directories.
+
+  Falls back to settings.TEMPLATE_DIRS when no template of ours is being
+  loaded or rendered, e.g. for google.appengine.ext.webapp.template.
+  """
+  if not template_dirs:
+    template_dirs = getattr(_bound, 'template_dirs', None)
+  return filesystem.load_template_source(template_name, template_dirs)
+load_template_source.is_usable = True
+
+# Settings may already have been configured by webapp.template, so install
+# our loader directly.
+django.conf.settings.TEMPLATE_LOADERS = ('utils.template.load_template_source',)
+django.template.loader.template_source_loaders = None
+
 def render(template_path, template_dict, debug=False, template_dirs=()):
   """Renders the template at the given path with the given dict of values.
 
@@ -82,6 +121,20 @@ def render(template_path, template_dict, debug=False, template_dirs=()):
   return t.render(Context(template_dict))
 
 
+def stream(template_path, template_dict, write, debug=False, 
+           template_dirs=()):
+  """Renders the template like render(), passing chunks of output to write.
+
+  Extends and block nodes are descended into, so the page is handed over
+  one top-level node at a time instead of as one string.
+
+  Example usage:
+    stream("templates/index.html", {"name": "Bret"}, response.out.write)
+  """
+  t = load(template_path, debug, template_dirs)
+  t.stream(Context(template_dict), write)
+
+
 template_cache = {}
 def load(path, debug=False, template_dirs=()):
   """Loads the Django template from the given path.
@@ -91,46 +144,137 @@ def load(path, debug=False, template_dirs=()):
   if you want imports and extends to work in the template.
   """
   abspath = os.path.abspath(path)
+  cache_key = (abspath, tuple(template_dirs))
 
   if not debug:
-    template = template_cache.get(abspath, None)
+    template = template_cache.get(cache_key, None)
   else:
     template = None
 
   if not template:
     directory, file_name = os.path.split(abspath)
     if directory:
-      template_dirs = [directory] + template_dirs
-    new_settings = {
-        'TEMPLATE_DIRS': template_dirs,
-        'TEMPLATE_DEBUG': debug,
-        'DEBUG': debug,
-    }
-    old_settings = _swap_settings(new_settings)
-    try:
-      template = django.template.loader.get_template(file_name)
-    finally:
-      _swap_settings(old_settings)
+      template_dirs = [directory] + list(template_dirs)
+    template = _call_bound(template_dirs, debug, 
+                           django.template.loader.get_template, file_name)
 
     if not debug:
-      template_cache[abspath] = template
-
-    def wrap_render(context, orig_render=template.render):
-      URLNode = django.template.defaulttags.URLNode
-      save_urlnode_render = URLNode.render
-      old_settings = _swap_settings(new_settings)
-      try:
-        URLNode.render = _urlnode_render_replacement
-        return orig_render(context)
-      finally:
-        _swap_settings(old_settings)
-        URLNode.render = save_urlnode_render
+      template_cache[cache_key] = template
+
+    # Renders without binding template_dirs.  dev/tests/template_benchmark.py
+    # times the old settings swapping around it.
+    template.raw_render = template.render
+
+    def wrap_render(context, orig_render=template.raw_render):
+      return _call_bound(template_dirs, debug, orig_render, context)
 
     template.render = wrap_render
 
+    def wrap_stream(context, write, nodelist=template.nodelist, 
+                    name=file_name):
+      return _call_bound(template_dirs, debug, _profiled, name,
+                         _stream_nodelist, nodelist, context, write)
+
+    template.stream = wrap_stream
+
   return template
 
 
+def _call_bound(template_dirs, debug, func, *args):
+  """Calls func with template_dirs bound for our template loader.
+
+  Only in debug mode are the DEBUG settings swapped in, since Django reads
+  them globally.
+  """
+  saved_dirs = getattr(_bound, 'template_dirs', None)
+  _bound.template_dirs = template_dirs
+  if debug:
+    old_settings = _swap_settings({'TEMPLATE_DEBUG': True, 'DEBUG': True})
+  try:
+    return func(*args)
+  finally:
+    _bound.template_dirs = saved_dirs
+    if debug:
+      _swap_settings(old_settings)
+
+
+def _stream_nodelist(nodelist, context, write):
+  """Writes the output of each node in nodelist, descending into the
+  {% extends %} and {% block %} nodes that make up most of a page."""
+  for node in nodelist:
+    if isinstance(node, django.template.loader_tags.ExtendsNode):
+      _stream_nodelist(_extend(node, context).nodelist, context, write)
+    elif isinstance(node, django.template.loader_tags.BlockNode):
+      # Same as BlockNode.render, which keeps context for block.super.
+      context.push()
+      node.context = context
+      context['block'] = node
+      _stream_nodelist(node.nodelist, context, write)
+      context.pop()
+    elif isinstance(node, django.template.Node):
+      write(nodelist.render_node(node, context))
+    else:
+      write(node)
+
+
+def _extend(node, context):
+  """Returns node's compiled parent with the child's blocks swapped in.
+
+  This is ExtendsNode.render up to the point where it renders the parent.
+  """
+  BlockNode = django.template.loader_tags.BlockNode
+  compiled_parent = node.get_parent(context)
+  parent_is_child = isinstance(compiled_parent.nodelist[0], 
+                               django.template.loader_tags.ExtendsNode)
+  parent_blocks = dict([(n.name, n) for n in 
+                        compiled_parent.nodelist.get_nodes_by_type(BlockNode)])
+  for block_node in node.nodelist.get_nodes_by_type(BlockNode):
+    try:
+      parent_block = parent_blocks[block_node.name]
+    except KeyError:
+      # The block may be defined further up, in the parent's parent.
+      if parent_is_child:
+        compiled_parent.nodelist[0].nodelist.append(block_node)
+    else:
+      # Keep any existing parents and add a new one, for block.super.
+      parent_block.parent = block_node.parent
+      parent_block.add_parent(parent_block.nodelist)
+      parent_block.nodelist = block_node.nodelist
+  return compiled_parent
+
+
+def _profiled(name, func, *args):
+  """Calls func, adding its run time to RENDER_TIMINGS[name]."""
+  stack = getattr(_profile, 'stack', None)
+  if stack is None:
+    stack = _profile.stack = []
+  stack.append(0.0)
+  start_time = time.time()
+  try:
+    return func(*args)
+  finally:
+    elapsed_time = time.time() - start_time
+    child_time = stack.pop()
+    if stack:
+      stack[-1] += elapsed_time
+    timing = RENDER_TIMINGS.get(name)
+    if timing is None:
+      timing = RENDER_TIMINGS[name] = {
+        "runs": 0,
+        "duration": 0.0,
+        "self_duration": 0.0,
+        "min_time": None,
+        "max_time": None
+      }
+    timing["runs"] += 1
+    timing["duration"] += elapsed_time
+    timing["self_duration"] += elapsed_time - child_time
+    if timing["min_time"] is None or timing["min_time"] > elapsed_time:
+      timing["min_time"] = elapsed_time
+    if timing["max_time"] is None or timing["max_time"] < elapsed_time:
+      timing["max_time"] = elapsed_time
+
+
 def _swap_settings(new):
   """Swap in selected Django settings, returning old settings.
 
@@ -220,3 +364,45 @@ def _urlnode_render_replacement(self, context):
     return handler.get_url(implicit_args=True, *args)
   except webapp.NoUrlFoundError:
     return ''
+
+
+# Our {% url %} replacement is installed once rather than around each render.
+django.template.defaulttags.URLNode.render = _urlnode_render_replacement
+
+
+def _profiled_template_render(self, context, 
+                              orig_render=django.template.Template.render):
+  """Replacement for Template.render that records RENDER_TIMINGS.
+
+  Every compiled template goes through here, so included and extended
+  templates are timed along with the ones we load.
+  """
+  name = getattr(self, 'bloog_name', None) or '<Unknown Template>'
+  return _profiled(name, orig_render, self, context)
+
+django.template.Template.render = _profiled_template_render
+
+
+# Django 0.96 doesn't keep a template's name on the compiled template, so
+# tag templates with the name they were loaded by for RENDER_TIMINGS.
+# loader_tags imported get_template by name, so {% include %} needs its
+# copy replaced too.
+def _named_get_template(template_name, 
+                        orig_get_template=django.template.loader.get_template):
+  template = orig_get_template(template_name)
+  template.bloog_name = template_name
+  return template
+
+django.template.loader.get_template = _named_get_template
+django.template.loader_tags.get_template = _named_get_template
+
+
+def _named_get_parent(self, context, 
+    orig_get_parent=django.template.loader_tags.ExtendsNode.get_parent):
+  """Replacement for ExtendsNode.get_parent naming the parent template."""
+  parent = orig_get_parent(self, context)
+  if not getattr(parent, 'bloog_name', None):
+    parent.bloog_name = getattr(self, 'parent_name', None)
+  return parent
+
+django.template.loader_tags.ExtendsNode.get_parent = _named_get_parent
@@ -21,21 +21,52 @@
 # DEALINGS IN THE SOFTWARE.
 
 
+import cgi
+import email.utils
+import gzip
+import hashlib
 import logging
 import os
 import re
 import string
+import StringIO
 import time
+import urllib
 import urlparse
 
 from google.appengine.api import users
 from google.appengine.api import memcache
 
+import models
 from models.blog import Tag       # Might rethink if this is leaking into view
 from utils import template
+from utils import lru_cache
 import config
 
 NUM_FULL_RENDERS = {}       # Cached data for some timings.
+NUM_STALE_HITS = {}         # Stale views served while another request
+                            # re-renders them.
+NUM_FRAGMENT_RENDERS = {}   # Keyed by fragment name, not path.
+NUM_LOCAL_HITS = {}         # Views served from this instance's memory.
+NUM_MEMCACHE_HITS = {}      # Views served from memcache.
+
+# Views are kept in this instance's memory in front of memcache.  Entries
+# are keyed like memcache ones, so generation bumps reach both tiers.
+LOCAL_CACHE = lru_cache.LRUCache(config.BLOG['local_cache_bytes'])
+
+# Generation numbers this instance read from memcache, as
+#  family -> (generation, time read).  They're trusted for 
+#  BLOG['generation_cache_time'] seconds so local hits need no RPC.
+GENERATIONS = {}
+MAX_GENERATIONS = 10000
+
+RENDER_LOCK_TIME = 30       # Seconds a request may hold a re-render lock.
+
+# Urls and normalized cache keys seen per handler, to spot fragmentation
+#  of the page cache in /admin/timings.  Only the first MAX_TRACKED_KEYS
+#  of each are remembered.
+CACHE_KEYS = {}
+MAX_TRACKED_KEYS = 1000
 
 def do_build_tree(base, path, tree):
     for entry in os.listdir(os.path.join(base, path)):
@@ -62,8 +93,284 @@ def find_file(tree, path):
     else:
         return None
 
-def invalidate_cache():
-    memcache.flush_all()
+def generation_key(family):
+    if isinstance(family, unicode):
+        family = family.encode(config.BLOG['charset'])
+    return 'gen:' + family
+
+def get_generations(families):
+    """
+    Returns a dict of the current generation number for each cache family.
+    A family without a counter (never bumped, or evicted) is started at
+    the current time so keys built from an older generation can't reappear.
+    Numbers read in the last BLOG['generation_cache_time'] seconds are 
+    taken from GENERATIONS, so other instances see a bump that much later.
+    """
+    now = time.time()
+    generations = {}
+    gen_keys = {}
+    for family in families:
+        cached = GENERATIONS.get(family)
+        if cached and now - cached[1] < config.BLOG['generation_cache_time']:
+            generations[family] = cached[0]
+        else:
+            gen_keys[generation_key(family)] = family
+    if not gen_keys:
+        return generations
+    counters = memcache.get_multi(gen_keys.keys())
+    if len(GENERATIONS) > MAX_GENERATIONS:
+        GENERATIONS.clear()
+    for gen_key, family in gen_keys.iteritems():
+        generation = counters.get(gen_key)
+        if generation is None:
+            generation = int(now)
+            if not memcache.add(gen_key, str(generation)):
+                generation = memcache.get(gen_key) or generation
+        generations[family] = int(generation)
+        GENERATIONS[family] = (generations[family], now)
+    return generations
+
+def get_fragment(name, render_func, cache_time=None):
+    """
+    Returns the named template fragment (see utils/django_libs/cachedblock),
+    calling render_func only if neither this instance nor memcache holds
+    the current generation of the fragment's cache family.
+    """
+    if cache_time is None:
+        cache_time = config.BLOG['cache_time']
+    if not cache_time or not config.BLOG['cache_time']:
+        return render_func()
+    generations = get_generations([name, 'all'])
+    key = 'Fragment%d.%d:%s:%s' % (generations[name], generations['all'],
+                                   os.environ.get('CURRENT_VERSION_ID', ''),
+                                   name)
+    # Local entries keep the memcache expiry so cache_time holds in both.
+    local = LOCAL_CACHE.get(key)
+    if local is not None and local['expires'] > time.time():
+        return local['fragment']
+    data = memcache.get(key)
+    if data is None or data['expires'] <= time.time():
+        NUM_FRAGMENT_RENDERS[name] = NUM_FRAGMENT_RENDERS.get(name, 0) + 1
+        data = {'fragment': render_func(), 
+                'expires': time.time() + cache_time}
+        memcache.set(key, data, cache_time)
+    LOCAL_CACHE.set(key, data, len(data['fragment']))
+    return data['fragment']
+
+class LazyList(object):
+    """
+    A list that's only fetched by calling func when a template first
+    tests, sizes or iterates over it.  Django 0.96 doesn't call callables
+    it finds in the context, so the deferral has to live in the value.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.items = None
+
+    def get_items(self):
+        if self.items is None:
+            self.items = list(self.func())
+        return self.items
+
+    def __iter__(self):
+        return iter(self.get_items())
+
+    def __len__(self):
+        return len(self.get_items())
+
+    def __nonzero__(self):
+        return bool(self.get_items())
+
+    def __getitem__(self, index):
+        return self.get_items()[index]
+
+def article_dependencies(article):
+    """
+    Returns the cache families a write to the given article touches:
+    the article itself, the listings and feed it appears in, its tag
+    pages and its year/month archives.
+    """
+    dependencies = ['article:' + article.permalink, 'listing', 'feed']
+    dependencies += ['tag:' + tag for tag in article.tags]
+    if article.published:
+        year = article.published.year
+        dependencies.append('archive:%d' % year)
+        dependencies.append('archive:%d/%d' % (year, article.published.month))
+    return dependencies
+
+def invalidate_cache(dependencies=None):
+    """
+    Bumps the generation of each given cache family, e.g.
+    ['article:2008/5/my-post', 'tags'], so cached pages keyed on an older 
+    generation are never looked up again and age out of memcache.
+    Without dependencies, the 'all' family every page and fragment 
+    depends on is bumped and the tag list is dropped.  Memcache isn't 
+    flushed since it holds buffered counter changes.
+    """
+    if dependencies is None:
+        memcache.delete(Tag.memcache_key())
+        dependencies = ['all']
+    logging.debug("Bumping cache generations for %s", dependencies)
+    for family in set(dependencies):
+        GENERATIONS.pop(family, None)
+        gen_key = generation_key(family)
+        if memcache.incr(gen_key) is None:
+            memcache.add(gen_key, str(int(time.time())))
+
+def http_date(timestamp):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def parse_http_date(date_string):
+    parsed = email.utils.parsedate_tz(date_string)
+    if parsed:
+        return email.utils.mktime_tz(parsed)
+    return None
+
+def gzip_string(data):
+    buf = StringIO.StringIO()
+    zfile = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=6)
+    zfile.write(data)
+    zfile.close()
+    return buf.getvalue()
+
+def gunzip_string(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+def count_hit(hits, handler):
+    path = handler.request.path
+    hits[path] = hits.get(path, 0) + 1
+
+def get_output(data):
+    """Returns the plain output of a view, decompressing a cached one."""
+    if 'output' not in data:
+        data['output'] = gunzip_string(data['gzip'])
+    return data['output']
+
+def get_gzip(data):
+    """Returns the gzipped output of a view, compressing it if needed."""
+    if 'gzip' not in data:
+        data['gzip'] = gzip_string(data['output'])
+    return data['gzip']
+
+def set_local_view(key, data):
+    """
+    Keeps a cached view in LOCAL_CACHE in the form it's sent in: gzipped
+    when BLOG['send_gzip'] is on, and already decompressed otherwise, 
+    so local hits don't gunzip on every request.  Returns the stored 
+    dict, which mustn't be changed.
+    """
+    data = dict(data)
+    if config.BLOG['send_gzip']:
+        data.pop('output', None)
+        LOCAL_CACHE.set(key, data, len(data['gzip']))
+    else:
+        output = get_output(data)
+        del data['gzip']
+        LOCAL_CACHE.set(key, data, len(output))
+    return data
+
+def accepts_gzip(handler):
+    encodings = handler.request.headers.get('Accept-Encoding', '')
+    return 'gzip' in [enc.split(';')[0].strip() 
+                      for enc in encodings.lower().split(',')]
+
+def add_vary(handler, header):
+    """Adds a request header to the response's Vary header."""
+    vary = handler.response.headers.get('Vary')
+    if vary:
+        header = vary + ', ' + header
+    handler.response.headers['Vary'] = header
+
+def accepts_json(handler):
+    """True if javascript is #1 in the Accept header."""
+    accept_list = handler.request.headers.get('Accept')
+    return bool(accept_list) and \
+           accept_list.split(',')[0].strip() == 'application/json'
+
+def write_json_list(handler, model_objs, fields=None):
+    """
+    Writes models to the response as a JSON array, one model at a time,
+    so the array is never built as one string.  With fields, only those
+    properties of each model are sent.
+    """
+    handler.response.headers['Content-Type'] = 'application/json'
+    out = handler.response.out
+    out.write('[')
+    separator = ''
+    for json in models.to_json_list(model_objs, fields):
+        out.write(separator)
+        out.write(json)
+        separator = ','
+    out.write(']')
+
+def canonical_url(handler):
+    """
+    Returns the request url normalized for use in cache keys: repeated
+    and trailing slashes are dropped from the path, and only the query
+    parameters named in the handler's cache_query_params are kept, sorted.
+    """
+    scheme, netloc, path, query, fragment = \
+        urlparse.urlsplit(handler.request.url)
+    path = re.sub('/+', '/', path)
+    if len(path) > 1:
+        path = path.rstrip('/')
+    params = []
+    for name in getattr(handler, 'cache_query_params', ()):
+        for value in handler.request.get_all(name):
+            if isinstance(value, unicode):
+                value = value.encode(config.BLOG['charset'])
+            params.append((name, value))
+    params.sort()
+    return urlparse.urlunsplit((scheme, netloc, path, 
+                                urllib.urlencode(params), ''))
+
+def track_cache_key(handler, url):
+    route = handler.__class__.__name__
+    seen = CACHE_KEYS.setdefault(route, {'urls': set(), 'keys': set()})
+    for name, value in (('urls', handler.request.url), ('keys', url)):
+        if len(seen[name]) < MAX_TRACKED_KEYS:
+            seen[name].add(value)
+
+def get_role():
+    """Returns 'admin', 'user' or 'anonymous' for the current user."""
+    if users.is_current_user_admin():
+        return 'admin'
+    if users.get_current_user():
+        return 'user'
+    return 'anonymous'
+
+# Views cached for signed-in users are rendered with these markers in place
+# of user-specific values.  substitute_user() fills them in per request.
+NICKNAME_MARKER = '<!--bloog:nickname-->'
+EMAIL_MARKER = '<!--bloog:email-->'
+LOGIN_URL_MARKER = '<!--bloog:login_url-->'
+LOGOUT_URL_MARKER = '<!--bloog:logout_url-->'
+
+class UserPlaceholder(object):
+    """Stands in for users.User in views shared by all users of a role."""
+    def nickname(self):
+        return NICKNAME_MARKER
+
+    def email(self):
+        return EMAIL_MARKER
+
+def substitute_user(handler, data):
+    """
+    Returns a copy of a view rendered with UserPlaceholder where the
+    markers are replaced by the current user's values.
+    """
+    user = users.get_current_user()
+    output = get_output(data)
+    for marker, value in [
+            (NICKNAME_MARKER, cgi.escape(user.nickname())),
+            (EMAIL_MARKER, cgi.escape(user.email())),
+            (LOGIN_URL_MARKER, users.create_login_url(handler.request.uri)),
+            (LOGOUT_URL_MARKER, users.create_logout_url(handler.request.uri))]:
+        if isinstance(value, unicode):
+            value = value.encode(config.BLOG['charset'])
+        output = output.replace(marker, value)
+    return {'output': output,
+            'etag': '"%s"' % hashlib.md5(output).hexdigest()}
 
 def to_filename(camelcase_handler_str):
     filename = camelcase_handler_str[0].lower()
@@ -74,6 +381,66 @@ def to_filename(camelcase_handler_str):
             filename += ch
     return filename
 
+def get_template_dirs(app_name, module_name):
+    """
+    Get template directory hierarchy -- Needed if we inherit from templates
+    in directories above us (due to sharing with other templates).
+    """
+    themes = config.BLOG['theme']
+    if isinstance(themes, basestring):
+      themes = [themes]
+    template_dirs = []
+    views_dir = os.path.join(config.APP_ROOT_DIR, 'views')
+    for theme in themes:
+      root_folder = os.path.join(views_dir, theme)
+      if module_name:
+          template_dirs += (os.path.join(root_folder, app_name, module_name),)
+      if app_name:
+          template_dirs += (os.path.join(root_folder, app_name),)
+      template_dirs += (root_folder,)
+    return template_dirs
+
+def precompile_templates():
+    """
+    Compiles every handler template in the templates tree, plus the
+    notfound.html fallback, with the directories get_view_file() would
+    pass along, so requests find them in the template cache.
+
+    Returns:
+      Number of templates compiled.
+    """
+    num_compiled = 0
+    for app_name, app_tree in templates.iteritems():
+        if not isinstance(app_tree, dict):
+            continue
+        for module_name, module_tree in app_tree.iteritems():
+            if not isinstance(module_tree, dict):
+                continue
+            template_dirs = get_template_dirs(app_name, module_name)
+            filenames = [name for name, entry in module_tree.iteritems()
+                         if not isinstance(entry, dict)]
+            for filename in filenames + ['notfound.html']:
+                try:
+                    template.load(filename, config.DEBUG, template_dirs)
+                    num_compiled += 1
+                except Exception, e:
+                    logging.error("Couldn't precompile %s/%s/%s: %s", 
+                                  app_name, module_name, filename, e)
+    return num_compiled
+
+# Template filename suffixes to try for each role, most specific first.
+ROLE_SUFFIXES = {
+    'admin': ('.admin.', '.user.', '.'),
+    'user': ('.user.', '.'),
+    'anonymous': ('.',),
+}
+
+# Resolved templates, keyed by handler class, verb, role, extension and
+#  any overrides passed in params.  The views tree is only read at startup
+#  so a resolution never goes stale.  See get_view_file().
+VIEW_FILES = {}
+VIEW_FILE_OVERRIDES = ('app_name', 'module_name', 'handler_name')
+
 def get_view_file(handler, params={}):
     """
     Looks for presence of template files with priority given to 
@@ -86,21 +453,30 @@ def get_view_file(handler, params={}):
     Only <handler> and <ext> are required.
     Properties 'module_name' and 'handler_name' can be passed in 
      params to override the current module/handler name.
+
+    Resolutions are memoized in VIEW_FILES, so only the role check
+     is done on each request.
      
     Returns:
-      Tuple with first element = template file name and
-      second element = template directory path tuple
+      Dict with 'file' = template file name and
+      'dirs' = template directory list
     """
-    if 'ext' in params:
-        desired_ext = params['ext']
-    else:
-        desired_ext = 'html'
+    overrides = tuple([(name, params[name]) for name in VIEW_FILE_OVERRIDES
+                       if name in params])
+    key = (handler.__class__, handler.request.method.lower(), get_role(),
+           params.get('ext', 'html'), overrides)
+    try:
+        return VIEW_FILES[key]
+    except KeyError:
+        template_info = resolve_view_file(*key)
+        VIEW_FILES[key] = template_info
+        return template_info
 
-    verb = handler.request.method.lower()
+def resolve_view_file(cls, verb, role, desired_ext, overrides):
+    """Finds the template for get_view_file() in the views tree."""
     app_name = ''
     module_name = None
     handler_name = None
-    cls = handler.__class__
     if (cls.__module__.startswith('handlers.')
         and cls.__name__.endswith('Handler')):
         handler_path = cls.__module__.split('.')
@@ -109,67 +485,107 @@ def get_view_file(handler, params={}):
         module_name = to_filename(handler_path[-1])
         handler_name = to_filename(cls.__name__.partition('Handler')[0])
 
-    if 'app_name' in params:
-        app_name = params['app_name']
-    if 'module_name' in params:
-        module_name = params['module_name']
-    if 'handler_name' in params:
-        handler_name = params['handler_name']
+    overrides = dict(overrides)
+    app_name = overrides.get('app_name', app_name)
+    module_name = overrides.get('module_name', module_name)
+    handler_name = overrides.get('handler_name', handler_name)
+
+    template_dirs = get_template_dirs(app_name, module_name)
 
-    # Get template directory hierarchy -- Needed if we inherit from templates
-    # in directories above us (due to sharing with other templates).
-    themes = config.BLOG['theme']
-    if isinstance(themes, basestring):
-      themes = [themes]
-    template_dirs = []
-    views_dir = os.path.join(config.APP_ROOT_DIR, 'views')
-    for theme in themes:
-      root_folder = os.path.join(views_dir, theme)
-      if module_name:
-          template_dirs += (os.path.join(root_folder, app_name, module_name),)
-      if app_name:
-          template_dirs += (os.path.join(root_folder, app_name),)
-      template_dirs += (root_folder,)
-        
     # Now check possible extensions for the given template file.
     if module_name and handler_name:
         entries = templates.get(app_name, {}).get(module_name, {})
-        possible_roles = []
-        if users.is_current_user_admin():
-            possible_roles.append('.admin.')
-        if users.get_current_user():
-            possible_roles.append('.user.')
-        possible_roles.append('.')
-        for role in possible_roles:
-            filename = ''.join([handler_name, role, verb, '.', desired_ext])
+        possible_roles = ROLE_SUFFIXES[role]
+        for suffix in possible_roles:
+            filename = ''.join([handler_name, suffix, verb, '.', desired_ext])
             if filename in entries:
                 return {'file': filename, 'dirs': template_dirs}
-        for role in possible_roles:
-            filename = ''.join([handler_name, role, desired_ext])
+        for suffix in possible_roles:
+            filename = ''.join([handler_name, suffix, desired_ext])
             if filename in entries:
                 return {'file': filename, 'dirs': template_dirs}
     return {'file': 'notfound.html', 'dirs': template_dirs}
 
 class ViewPage(object):
-    def __init__(self, cache_time=None):
-        """Each ViewPage has a variable cache timeout"""
+    def __init__(self, cache_time=None, depends_on=None):
+        """
+        Each ViewPage has a variable cache timeout and a list of cache
+        dependencies (see article_dependencies) beyond those found in
+        the rendered articles.
+        """
         if cache_time == None:
             self.cache_time = config.BLOG['cache_time']
         else:
             self.cache_time = cache_time
+        self.depends_on = depends_on or []
+
+    def get_dependencies(self, template_params):
+        """
+        Returns this page's cache families, including the article it 
+        shows.  Listed articles don't need their own families because
+        article_dependencies() bumps every listing family an article
+        can appear in.  The sidebar's tag list is a cached fragment with
+        its own 'tags' family, so tag changes don't invalidate pages.
+        Every page also depends on 'all' (see invalidate_cache).
+        """
+        dependencies = ['all'] + self.depends_on
+        if template_params.get('article'):
+            article = template_params['article']
+            dependencies.append('article:' + article.permalink)
+        return dependencies
 
-    def full_render(self, handler, template_info, more_params):
-        """Render a dynamic page from scatch."""
+    def cache_key(self, handler, template_params, role):
+        """
+        Prefixes the url with the generations of the page's cache families
+        so bumping any of them makes the cached page unreachable.  Each
+        role gets its own variant, matching the role-specific templates
+        picked by get_view_file().
+        """
+        generations = get_generations(self.get_dependencies(template_params))
+        families = generations.keys()
+        families.sort()
+        prefix = '.'.join([str(generations[family]) for family in families])
+        url = canonical_url(handler)
+        track_cache_key(handler, url)
+        return 'Page' + prefix + ':' + role + ':' + url
+
+    def full_render(self, handler, template_info, more_params, 
+                    use_placeholders=False):
+        """Render a dynamic page from scatch.  With use_placeholders, 
+           user-specific values are left as markers for substitute_user()."""
         logging.debug("Doing full render using template_file: %s", template_info['file'])
-        url = handler.request.uri
-        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        template_params = self.get_template_params(handler, more_params,
+                                                   use_placeholders)
+        return template.render(template_info['file'], template_params,
+                               debug=config.DEBUG, 
+                               template_dirs=template_info['dirs'])
 
-        global NUM_FULL_RENDERS
-        if not path in NUM_FULL_RENDERS:
-            NUM_FULL_RENDERS[path] = 0
-        NUM_FULL_RENDERS[path] += 1     # This lets us see % of cached views
-                                        # in /admin/timings (see timings.py)
-        tags = Tag.list()
+    def stream_render(self, handler, template_info, more_params):
+        """Render a dynamic page from scratch straight into the response,
+           without building the whole page as one string."""
+        logging.debug("Streaming render using template_file: %s", template_info['file'])
+        template_params = self.get_template_params(handler, more_params)
+        charset = config.BLOG['charset']
+        out = handler.response.out
+        def write(chunk):
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(charset)
+            out.write(chunk)
+        template.stream(template_info['file'], template_params, write,
+                        debug=config.DEBUG, 
+                        template_dirs=template_info['dirs'])
+
+    def get_template_params(self, handler, more_params, 
+                            use_placeholders=False):
+        """Returns the parameters for a full render, updated with 
+           more_params.  Cached views are shared by every url with the 
+           same canonical_url(), so their urls are built from it."""
+        url = handler.request.uri
+        if self.cache_time:
+            url = canonical_url(handler)
+        count_hit(NUM_FULL_RENDERS, handler)    # This lets us see % of 
+                                                # cached views in 
+                                                # /admin/timings
 
         # Define some parameters it'd be nice to have in views by default.
         template_params = {
@@ -177,41 +593,121 @@ class ViewPage(object):
             "bloog_version": config.BLOG['bloog_version'],
             "user": users.get_current_user(),
             "user_is_admin": users.is_current_user_admin(),
-            "login_url": users.create_login_url(handler.request.uri),
-            "logout_url": users.create_logout_url(handler.request.uri),
+            "login_url": users.create_login_url(url),
+            "logout_url": users.create_logout_url(url),
             "blog": config.BLOG,
-            "blog_tags": tags
+            "blog_tags": LazyList(Tag.list) # Only needed if the tags
+                                            # fragment isn't cached.
         }
+        if use_placeholders:
+            template_params.update({
+                "user": UserPlaceholder(),
+                "login_url": LOGIN_URL_MARKER,
+                "logout_url": LOGOUT_URL_MARKER
+            })
         template_params.update(config.PAGE)
         template_params.update(more_params)
-        return template.render(template_info['file'], template_params,
-                               debug=config.DEBUG, 
-                               template_dirs=template_info['dirs'])
+        return template_params
 
-    def render_or_get_cache(self, handler, template_info, template_params={}):
+    def get_view(self, handler, template_info, template_params={}):
+        """
+        Returns the view for the current user's role, with user-specific
+        values filled in for signed-in users (see get_role_view).
+        """
+        role = get_role()
+        data = self.get_role_view(handler, template_info, template_params, 
+                                  role)
+        if self.cache_time and role != 'anonymous':
+            data = substitute_user(handler, data)
+        return data
+
+    def get_role_view(self, handler, template_info, template_params, role):
         """Checks if there's a non-stale cached version of this view, 
-           and if so, return it."""
-        user = users.get_current_user()
-        key = handler.request.url
-        if self.cache_time and not user:
+           and if so, return it.
+           
+           Views are cached for cache_time plus BLOG['cache_stale_time'].
+           Past cache_time, the first request to grab the render lock
+           re-renders the view while other requests keep getting the stale
+           copy, so an expiring popular page is only rendered once.
+
+           Only the gzipped output is kept in memcache, which roughly
+           quarters the size of each cached view.  Fresh views are also
+           kept in LOCAL_CACHE so hits on this instance skip the memcache
+           get (see set_local_view).
+
+           Returns:
+             Dict with the view's 'etag' and its 'output' and/or 'gzip'
+             bytes (see get_output and get_gzip).
+        """
+        if self.cache_time:
+            key = self.cache_key(handler, template_params, role)
             # See if there's a cache within time.
             # The cache key suggests a problem with the url <-> function 
             #  mapping, because a significant advantage of RESTful design 
             #  is that a distinct url gets you a distinct, cacheable 
             #  resource.  If we have to include states like "user?" and 
             #  "admin?", then it suggests these flags should be in url.               
-            # TODO - Think about the above with respect to caching.
+            # For now, each role gets a variant and user-specific values
+            #  are filled in afterwards by substitute_user().
+            data = LOCAL_CACHE.get(key)
+            if data is not None and data['expires'] > time.time():
+                count_hit(NUM_LOCAL_HITS, handler)
+                return dict(data)
             try:
                 data = memcache.get(key)
             except ValueError:
                 data = None
             if data is not None:
-                return data
+                if data['expires'] > time.time():
+                    count_hit(NUM_MEMCACHE_HITS, handler)
+                    return dict(set_local_view(key, data))
+                if not memcache.add('Lock' + key, 1, RENDER_LOCK_TIME):
+                    count_hit(NUM_STALE_HITS, handler)
+                    return data
 
-        output = self.full_render(handler, template_info, template_params)
-        if self.cache_time and not user:
-            memcache.add(key, output, self.cache_time)
-        return output
+        output = self.full_render(handler, template_info, template_params,
+                                  self.cache_time and role != 'anonymous')
+        if isinstance(output, unicode):
+            output = output.encode(config.BLOG['charset'])
+        data = {'expires': time.time() + self.cache_time, 
+                'last_modified': int(time.time()),
+                'etag': '"%s"' % hashlib.md5(output).hexdigest()}
+        if self.cache_time:
+            data['gzip'] = gzip_string(output)
+            memcache.set(key, data, 
+                         self.cache_time + config.BLOG['cache_stale_time'])
+            data['output'] = output
+            set_local_view(key, data)
+        data['output'] = output
+        return data
+
+    def render_or_get_cache(self, handler, template_info, template_params={}):
+        """Returns the output of get_view()."""
+        return get_output(self.get_view(handler, template_info, 
+                                        template_params))
+
+    def is_not_modified(self, handler, last_modified):
+        """
+        Answers a conditional GET carrying only If-Modified-Since.
+        last_modified is when the cached view was rendered, so any write
+        that invalidates the view (comments and deletes included) moves 
+        it forward.
+        """
+        if handler.request.method != 'GET' or not last_modified or \
+           handler.request.headers.get('If-None-Match'):
+            return False
+        since = parse_http_date(
+                    handler.request.headers.get('If-Modified-Since', ''))
+        return since is not None and last_modified <= since
+
+    def matches_etag(self, handler, etag):
+        if handler.request.method != 'GET':
+            return False
+        if_none_match = handler.request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        etags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in etags or '*' in etags
 
     def render(self, handler, params={}):
         """
@@ -219,10 +715,35 @@ class ViewPage(object):
         include:
             'ext': 'xml' (or any other format type)
         """
+        # Error pages (404, 403) are always sent with their body.
+        conditional = handler.response.status() == 200
         template_info = get_view_file(handler, params)
         logging.debug("Using template at %s", template_info['file'])
-        output = self.render_or_get_cache(handler, template_info, params)
-        handler.response.out.write(output)
+        if not self.cache_time:
+            # Nothing to cache, so skip the ETag and write as we render.
+            self.stream_render(handler, template_info, params)
+            return
+        data = self.get_view(handler, template_info, params)
+        send_gzip = config.BLOG['send_gzip'] and accepts_gzip(handler)
+        etag = data['etag']
+        if send_gzip:
+            etag = etag[:-1] + '-gzip"'
+        if config.BLOG['send_gzip']:
+            add_vary(handler, 'Accept-Encoding')
+        handler.response.headers['ETag'] = etag
+        # Views filled in for a signed-in user only go by their ETag.
+        last_modified = data.get('last_modified')
+        if last_modified:
+            handler.response.headers['Last-Modified'] = http_date(last_modified)
+        if conditional and (self.matches_etag(handler, etag) or 
+                            self.is_not_modified(handler, last_modified)):
+            handler.response.set_status(304)
+            return
+        if send_gzip:
+            handler.response.headers['Content-Encoding'] = 'gzip'
+            handler.response.out.write(get_gzip(data))
+        else:
+            handler.response.out.write(get_output(data))
 
     def render_query(self, handler, model_name, query, params={},
                      num_limit=config.PAGE['articles_per_page'],
@@ -233,6 +754,15 @@ class ViewPage(object):
         """
         limit = string.atoi(handler.request.get("limit") or str(num_limit))
         offset = string.atoi(handler.request.get("offset") or str(num_offset))
+        # The same url answers with HTML or JSON.
+        add_vary(handler, 'Accept')
+        if accepts_json(handler):
+            fields = handler.request.get("fields")
+            if fields:
+                fields = [field.strip() for field in fields.split(',')]
+            write_json_list(handler, query.fetch(limit, offset), 
+                            fields or None)
+            return
         # Trick is to ask for one more than you need to see if 'next' needed.
         models = query.fetch(limit+1, offset)
         render_params = {model_name: models, 'limit': limit}